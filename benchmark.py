@@ -0,0 +1,492 @@
+# Benchmarks for the Wayback Caching Proxy
+# python benchmark.py paths [iterations] - per-request CPU of the url -> cache path mapping, legacy vs current
+# python benchmark.py proxy [trace.jsonl|sample] [concurrency] [latency_ms] [throttle_rate] - replay a browsing trace through the proxy against a local fake Wayback, cold, warm and mixed
+# python benchmark.py trace <out.jsonl> [pages] - write a sample browsing trace to edit or replay
+# python benchmark.py results [count] - compare the latest stored proxy runs
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import datetime
+import tempfile
+import threading
+import subprocess
+import socket
+import http.server
+from urllib import parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import uvicorn
+
+main = None # imported by load_main, from the directory the proxy should keep its cache in
+results_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results.jsonl")
+
+def load_main(work_dir = None):
+    """Import main, which builds the proxy and its cache in the current directory, so move to work_dir first"""
+    global main
+    if work_dir is not None:
+        os.chdir(work_dir)
+    import main as main_module
+    main = main_module
+    return main
+
+# The mapping as it was before url_to_cache_path, kept here to compare against (index lookup and prints left out)
+def legacy_normalize_request_url(request_url, host_address, external_ip):
+    path = request_url
+    host_address_string = f"http://{host_address}:8002/"
+    remote_host_address_string = f"http://{external_ip}:8002/"
+    if path.startswith(host_address_string):
+        path = path[len(host_address_string):]
+    if path.startswith(remote_host_address_string):
+        path = path[len(remote_host_address_string):]
+    if path.startswith("http:/"):
+        path = path.replace("http:/","")
+    if path.startswith("https:/"):
+        path = path.replace("https:/","")
+    while path.startswith("/"):
+        path = path[1:]
+    return "http://"+path
+
+def legacy_get_url_info(url, parameters, request_accepts, req_year, req_month, req_day, cache_dir = "./cache"):
+    if url.startswith("https://web.archive.org/web/"):
+        url = url.replace("https://web.archive.org/web/","")
+    if url.startswith("/"):
+        url = url[1:]
+    assert (url.startswith("http://") or url.startswith("https://")), "URL must start with http:// or https://"
+
+    path_chunks = url.replace("http://","").replace("https://","").split("/")
+    domain_parts = path_chunks.pop(0).split(".")
+    domain_parts = ["domain-"+part for part in domain_parts]
+    domain_parts[-1] = "tld-" + domain_parts[-1].replace("domain-","")
+    domain_parts.reverse()
+
+    path_parts = []
+    for part in domain_parts:
+        path_parts.append(part)
+    path_parts += path_chunks
+    path_parts = [part for part in path_parts if part != ""]
+    path_parts = [part.replace(",","").replace(";","").replace(":","").replace("%","").replace("?","").replace("&","").replace("=","").replace("+","").replace("#","").replace("@","") for part in path_parts]
+
+    most_recent_date = datetime.datetime(req_year, req_month, req_day)
+    relative_path = []
+    for part in path_parts:
+        if part == "http://www" or part == "https://www" or part == "www":
+            continue
+        relative_path.append(part)
+    relative_path = "/".join(relative_path)
+
+    internet_file_path = [cache_dir, str(most_recent_date.year), str(most_recent_date.month), str(most_recent_date.day)]
+    config_file_path = []
+    for part in path_parts:
+        if part == "http://www" or part == "https://www" or part == "www":
+            continue
+        internet_file_path.append(part)
+        config_file_path.append(part)
+    internet_file_path = "/".join(internet_file_path)
+    internet_file_path = internet_file_path.replace("http://","").replace("https://","").replace(":8080","")
+    config_file_path = "/".join(config_file_path)
+    config_file_path = config_file_path.replace("http://","").replace("https://","").replace(":8080","")
+
+    if internet_file_path[-1] == "/":
+        if request_accepts == "text/html":
+            internet_file_path += "index.html"
+        else:
+            internet_file_path += "index."+request_accepts.split("/")[1]
+    else:
+        dot_count = internet_file_path.count(".")
+        if dot_count <= 1:
+            if request_accepts == "text/html":
+                internet_file_path += "/index.html"
+            else:
+                internet_file_path += "."+request_accepts.split("/")[1]
+
+    internet_dir_path = "/".join(internet_file_path.split("/")[:-1])
+    if internet_dir_path[-1] != "/":
+        internet_dir_path += "/"
+    filename = internet_file_path.split("/")[-1]
+    file_type = "file"
+    image_filetypes = ["png","jpg","jpeg","gif"]
+    file_extension = filename.split(".")[-1]
+    if file_extension == "html" or file_extension == "php":
+        file_type = "html"
+    if file_extension in image_filetypes:
+        file_type = "image"
+    elif file_extension == "css":
+        file_type = "css"
+    parameters = parameters.split("&")
+    for parameter in parameters:
+        if parameter == "":
+            continue
+        parameter = parameter.replace("=","--")
+        filename += "." + parameter
+        internet_file_path += "." + parameter
+    return internet_file_path, internet_dir_path, filename, file_type, file_extension
+
+def current_get_url_info(url, parameters, request_accepts, req_year, req_month, req_day, cache_dir = "./cache"):
+    index_path, file_path, dir_path, filename, file_type, file_extension = main.url_to_cache_path(url, parameters, request_accepts)
+    day_path = f"{cache_dir}/{req_year}/{req_month}/{req_day}/"
+    return day_path + file_path, day_path + dir_path, filename, file_type, file_extension
+
+def sample_requests(count:int = 2000, seed:int = 1):
+    """Request urls shaped like a browsing session: a few sites, pages pulling in the same assets over and over"""
+    rng = random.Random(seed)
+    sites = ["www.google.com", "news.bbc.co.uk", "example.com", "www.geocities.com", "forums.example.org:8080", "localhost"]
+    pages = ["", "index.html", "news/world/", "search?q=hello+world&hl=en", "a/b/c/page.php?id=12&s=x%20y", "~user/home", "@foo,bar;baz"]
+    assets = [("style.css", "text/css"), ("img/logo.png", "image/avif"), ("js/app.js", "*/*"), ("images/spacer.gif", "image/avif"), ("favicon", "*/*")]
+    request_urls = []
+    for _ in range(count):
+        site = rng.choice(sites)
+        if rng.random() < 0.3:
+            path, accept = rng.choice(pages), "text/html"
+        else:
+            path, accept = rng.choice(assets)
+            if rng.random() < 0.2:
+                path = f"{rng.randint(1, 500)}/{path}" # the long tail that misses the memo cache
+        scheme = rng.choice(["http://", "https://"])
+        request_url = rng.choice([f"{scheme}{site}/{path}", f"http://{main.host_address}:8002/{scheme}{site}/{path}"])
+        request_urls.append((request_url, accept))
+    return request_urls
+
+def map_request(normalize, get_url_info, request_url, accept):
+    path = normalize(request_url, main.host_address, "10.0.0.1")
+    path, parameters = path.split("?", 1) if "?" in path else (path, "")
+    return get_url_info(path, parameters, accept, 2012, 10, 10)
+
+def time_mapping(normalize, get_url_info, requests, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        for request_url, accept in requests:
+            map_request(normalize, get_url_info, request_url, accept)
+    return (time.process_time() - start) / (iterations * len(requests))
+
+def benchmark_paths(iterations:int = 20):
+    load_main()
+    request_urls = sample_requests()
+    for request_url, accept in request_urls: # same mapping, or existing caches would be orphaned
+        assert map_request(legacy_normalize_request_url, legacy_get_url_info, request_url, accept) == map_request(main.normalize_request_url, current_get_url_info, request_url, accept), request_url
+    legacy = time_mapping(legacy_normalize_request_url, legacy_get_url_info, request_urls, iterations)
+    main.normalize_request_url.cache_clear()
+    main.url_to_cache_path.cache_clear()
+    cold = time_mapping(main.normalize_request_url, current_get_url_info, request_urls, 1)
+    warm = time_mapping(main.normalize_request_url, current_get_url_info, request_urls, iterations)
+    print(f"{len(request_urls)} requests, {len(set(request_urls))} distinct, {iterations} iterations")
+    print(f"legacy:          {legacy * 1e6:8.2f} us/request")
+    print(f"current (cold):  {cold * 1e6:8.2f} us/request")
+    print(f"current (warm):  {warm * 1e6:8.2f} us/request  ({legacy / warm:.1f}x)")
+    print("memo:", main.url_to_cache_path.cache_info())
+
+class FakeUpstream:
+    """Local stand-in for the Wayback id_ endpoint, the CDX server and the live-origin fallback, with configurable latency, 429s and payload sizes. Bodies and missing captures are derived from the url, so every run serves the same content"""
+    def __init__(self, latency_ms:float = 50, jitter_ms:float = 10, throttle_rate:float = 0.0, retry_after:int = 1, missing_rate:float = 0.05, payload_sizes:dict = None, seed:int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.throttle_rate = throttle_rate # fraction of capture requests answered with 429
+        self.retry_after = retry_after
+        self.missing_rate = missing_rate # fraction of urls Wayback doesn't have, half of which the origin fallback does
+        self.payload_sizes = payload_sizes or {"html": 20000, "css": 8000, "js": 30000, "image": 15000, "other": 100000} # typical body bytes, each url gets 50-150% of its type's
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.stats = {"captures": 0, "cdx": 0, "origin": 0, "throttled": 0, "missing": 0, "unexpected": 0, "bytes": 0}
+        self.expected_urls = None # urls the proxy should be asking for, see expect
+        self.unexpected_urls = [] # the first few it asked for anyway
+        self.server = None
+
+    def expect(self, urls):
+        """Only serve these urls, anything else is a routing bug in the proxy and gets a 404 and is counted"""
+        self.expected_urls = set(self.canonical(url) for url in urls)
+
+    @staticmethod
+    def canonical(url):
+        return url.replace("https://", "http://", 1)
+
+    def check_url(self, url):
+        if self.expected_urls is None or self.canonical(url) in self.expected_urls:
+            return True
+        self.stats["unexpected"] += 1
+        if len(self.unexpected_urls) < 10:
+            self.unexpected_urls.append(url)
+        return False
+
+    def start(self):
+        """Serve on a free local port in a thread. Returns the base url"""
+        upstream = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                upstream.handle(self)
+            def log_message(self, *args):
+                pass
+        class Server(http.server.ThreadingHTTPServer):
+            def handle_error(self, request, client_address):
+                if not isinstance(sys.exc_info()[1], ConnectionError): # clients hanging up on keep-alive connections is normal
+                    super().handle_error(request, client_address)
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def url_hash(url):
+        return int(hashlib.sha1(url.encode("utf-8")).hexdigest()[:8], 16)
+
+    @staticmethod
+    def kind(url):
+        extension = parse.urlsplit(url).path.rsplit("/", 1)[-1].rsplit(".", 1)
+        extension = extension[1].lower() if len(extension) > 1 else ""
+        if extension in ("", "html", "htm", "php"):
+            return "html"
+        if extension in ("png", "jpg", "jpeg", "gif"):
+            return "image"
+        if extension in ("css", "js"):
+            return extension
+        return "other"
+
+    def body(self, url):
+        """(content type, body) for url, the same every time"""
+        kind = self.kind(url)
+        size = int(self.payload_sizes[kind] * (0.5 + (self.url_hash(url) % 1000) / 1000))
+        if kind == "html":
+            link = f'<p><a href="https://{parse.urlsplit(url).hostname}/page.html">link</a> <img src="https://example.com/image.gif"> some text</p>\n'.encode("utf-8")
+            return "text/html; charset=utf-8", (b"<html><body>\n" + link * (size // len(link) + 1))[:size]
+        content_type = {"css": "text/css", "js": "application/javascript", "image": "image/gif", "other": "application/octet-stream"}[kind]
+        return content_type, (hashlib.sha256(url.encode("utf-8")).digest() * (size // 32 + 1))[:size]
+
+    def missing(self, url):
+        return (self.url_hash(url) % 10000) / 10000 < self.missing_rate
+
+    def handle(self, handler):
+        with self.rng_lock:
+            delay = max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            throttled = self.rng.random() < self.throttle_rate
+        time.sleep(delay)
+        path = handler.path
+        if path.startswith("/cdx/search/cdx?"):
+            self.stats["cdx"] += 1
+            query = parse.parse_qs(path.split("?", 1)[1])
+            if not self.check_url(query["url"][0]):
+                return self.respond(handler, 404, "text/plain", b"Not a url from the trace")
+            capture = (datetime.datetime.strptime(query["from"][0][:8], "%Y%m%d") + datetime.timedelta(days=365)).strftime("%Y%m%d120000") # the proxy date
+            rows = [["timestamp"]] if self.missing(query["url"][0]) else [["timestamp"], [capture]]
+            return self.respond(handler, 200, "application/json", json.dumps(rows).encode("utf-8"))
+        if path.startswith("/web/") and "id_/" in path:
+            url = path.split("id_/", 1)[1]
+            if not self.check_url(url):
+                return self.respond(handler, 404, "text/plain", b"Not a url from the trace")
+            if throttled:
+                self.stats["throttled"] += 1
+                return self.respond(handler, 429, "text/plain", b"Too Many Requests", {"Retry-After": str(self.retry_after)})
+            self.stats["captures"] += 1
+            if self.missing(url):
+                self.stats["missing"] += 1
+                return self.respond(handler, 404, "text/plain", b"Not in archive")
+            return self.respond(handler, 200, *self.body(url.replace("https://", "http://", 1)))
+        if path.startswith("/origin/"):
+            self.stats["origin"] += 1
+            url = "http://" + path[len("/origin/"):]
+            if not self.check_url(url):
+                return self.respond(handler, 404, "text/plain", b"Not a url from the trace")
+            if self.url_hash(url) % 2 == 0:
+                return self.respond(handler, 404, "text/plain", b"Not found")
+            return self.respond(handler, 200, *self.body(url))
+        self.respond(handler, 404, "text/plain", b"Unknown endpoint")
+
+    def respond(self, handler, status, content_type, body, headers = None):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        self.stats["bytes"] += len(body)
+
+def sample_trace(pages:int = 200, seed:int = 1):
+    """A browsing trace: pages on a handful of sites, each followed by its stylesheet, scripts and images, with sites sharing some assets"""
+    rng = random.Random(seed)
+    sites = ["www.geocities.com", "news.example.com", "example.com", "forums.example.org", "www.example.net"]
+    trace = []
+    for _ in range(pages):
+        site = rng.choice(sites)
+        page = rng.choice(["", "index.html", f"news/{rng.randint(1, 40)}.html", f"forum/viewtopic.php?t={rng.randint(1, 60)}", f"~user{rng.randint(1, 20)}/"])
+        trace.append({"url": f"http://{site}/{page}", "accept": "text/html"})
+        trace.append({"url": f"http://{site}/style.css", "accept": "text/css"})
+        for script in rng.sample(["js/app.js", "js/menu.js", "http://example.com/shared/counter.js"], 2):
+            trace.append({"url": script if script.startswith("http") else f"http://{site}/{script}", "accept": "*/*"})
+        for _ in range(rng.randint(2, 8)):
+            image = rng.choice([f"images/{rng.randint(1, 80)}.gif", f"photos/{rng.randint(1, 300)}.jpg", "images/spacer.gif", "http://example.com/image.gif"])
+            trace.append({"url": image if image.startswith("http") else f"http://{site}/{image}", "accept": "image/avif"})
+    return trace
+
+def load_trace(trace_path):
+    """Read a trace of JSON lines like {"url": ..., "accept": ..., "headers": {...}}, accept and headers optional"""
+    trace = []
+    with open(trace_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() != "":
+                entry = json.loads(line)
+                entry.setdefault("accept", "text/html")
+                trace.append(entry)
+    return trace
+
+def mix_trace(trace, new_fraction:float = 0.2, seed:int = 2):
+    """The same trace with new_fraction of its requests swapped for urls nothing has seen yet"""
+    rng = random.Random(seed)
+    mixed = []
+    for index, entry in enumerate(trace):
+        if rng.random() < new_fraction:
+            entry = dict(entry, url=entry["url"] + ("&" if "?" in entry["url"] else "?") + f"mixed={index}")
+        mixed.append(entry)
+    return mixed
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(percent / 100 * len(sorted_values)) - 1))]
+
+def replay(trace, proxy_url, concurrency):
+    """Send every request in trace through the proxy, concurrency at a time, the way a browser configured to use it would. Returns latency percentiles, throughput and status counts"""
+    local = threading.local()
+    def send(entry):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.proxies = {"http": proxy_url}
+        start = time.perf_counter()
+        try:
+            response = local.session.get(entry["url"], headers={"Accept": entry["accept"], **entry.get("headers", {})}, timeout=120)
+            size = len(response.content)
+            status = response.status_code
+        except requests.RequestException:
+            size = 0
+            status = "error"
+        return time.perf_counter() - start, status, size
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(send, trace))
+    wall = time.perf_counter() - start
+    latencies = sorted(latency for latency, status, size in results)
+    statuses = {}
+    for latency, status, size in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(trace),
+        "seconds": round(wall, 3),
+        "requests_per_second": round(len(trace) / wall, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0,
+        "bytes": sum(size for latency, status, size in results),
+        "statuses": statuses,
+    }
+
+def check_front_end_urls():
+    """The front end has to see the same url whichever way the request target reached it: absolute form as h11 passes it on, or just the path as httptools does"""
+    for url, host, path, query in [
+        ("http://news.example.com/style.css", "news.example.com", "/style.css", b""),
+        ("http://example.com/forum/viewtopic.php?t=12", "example.com", "/forum/viewtopic.php", b"t=12"),
+        ("https://example.com/", "example.com", "/", b""),
+    ]:
+        absolute_form = {"path": url.split("?")[0], "query_string": query}
+        origin_form = {"path": path, "query_string": query}
+        assert main.ProxyFrontEnd.request_url(absolute_form, host) == url, (url, main.ProxyFrontEnd.request_url(absolute_form, host))
+        if url.startswith("http://"):
+            assert main.ProxyFrontEnd.request_url(origin_form, host) == url, (url, main.ProxyFrontEnd.request_url(origin_form, host))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_revision():
+    try:
+        repo_dir = os.path.dirname(os.path.abspath(__file__))
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip() != ""
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_proxy(trace, trace_name = "sample", concurrency:int = 8, upstream:FakeUpstream = None, upstream_rate:float = 200):
+    """Replay trace through a fresh proxy (its own empty cache in a temp directory) against the fake upstream: cold cache, then warm, then mixed with 20% new urls. Prefetching is off so runs are comparable. The result is appended to benchmark_results.jsonl"""
+    upstream = upstream or FakeUpstream()
+    upstream_url = upstream.start()
+    os.environ["WAYCACHE_WAYBACK_URL"] = upstream_url
+    os.environ["WAYCACHE_ORIGIN_URL"] = upstream_url + "/origin"
+    os.environ.setdefault("WAYCACHE_LOG_LEVEL", "WARNING") # per-request logging would be measured too
+    load_main(tempfile.mkdtemp(prefix="waycache-benchmark-"))
+    check_front_end_urls()
+    main.waycache.worker_enabled = False
+    main.waycache.rate_limiter.host_limits[main.waycache.wayback_host] = {"rate": upstream_rate, "burst": upstream_rate, "concurrency": 32} # measure the proxy, not our politeness towards the real Wayback
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.proxy_app, host="127.0.0.1", port=port, log_level="warning", timeout_keep_alive=main.proxy_keep_alive))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    proxy_url = f"http://127.0.0.1:{port}"
+    print(f"Replaying {len(trace)} requests ({len(set(entry['url'] for entry in trace))} distinct) at concurrency {concurrency}, upstream latency {upstream.latency * 1000:.0f}ms, 429 rate {upstream.throttle_rate}")
+    workloads = {}
+    runs = [("cold", trace), ("warm", trace), ("mixed", mix_trace(trace))]
+    upstream.expect(entry["url"] for name, workload in runs for entry in workload)
+    for name, workload in runs:
+        workloads[name] = replay(workload, proxy_url, concurrency)
+        result = workloads[name]
+        print(f"{name:6} {result['requests_per_second']:8.1f} req/s  p50 {result['p50_ms']:8.2f}ms  p90 {result['p90_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  {result['statuses']}")
+    server.should_exit = True
+    upstream.stop()
+    print("upstream:", upstream.stats)
+    if upstream.unexpected_urls:
+        print("Proxy asked upstream for", upstream.stats["unexpected"], "urls that aren't in the trace, e.g.", upstream.unexpected_urls[:3])
+    run = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "trace": trace_name,
+        "concurrency": concurrency,
+        "upstream": {"latency_ms": upstream.latency * 1000, "jitter_ms": upstream.jitter * 1000, "throttle_rate": upstream.throttle_rate, "missing_rate": upstream.missing_rate, "payload_sizes": upstream.payload_sizes, "rate": upstream_rate},
+        "upstream_stats": upstream.stats,
+        "unexpected_urls": upstream.unexpected_urls,
+        "workloads": workloads,
+    }
+    with open(results_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+    print("Results appended to", results_path)
+    return run
+
+def print_results(count:int = 10):
+    """Show the last count stored proxy runs side by side"""
+    if not os.path.exists(results_path):
+        print("No stored results yet, run python benchmark.py proxy first")
+        return
+    with open(results_path, "r", encoding="utf-8") as f:
+        runs = [json.loads(line) for line in f if line.strip() != ""][-count:]
+    print(f"{'time':19}  {'revision':14} {'trace':12} {'workload':8} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for run in runs:
+        for name, result in run["workloads"].items():
+            print(f"{run['time']:19}  {str(run['revision']):14} {run['trace'][:12]:12} {name:8} {result['requests_per_second']:8.1f} {result['p50_ms']:9.2f} {result['p99_ms']:9.2f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "paths":
+        benchmark_paths(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    elif len(sys.argv) > 1 and sys.argv[1] == "proxy":
+        trace_path = sys.argv[2] if len(sys.argv) > 2 else "sample"
+        trace = sample_trace() if trace_path == "sample" else load_trace(os.path.abspath(trace_path))
+        upstream = FakeUpstream(latency_ms=float(sys.argv[4]) if len(sys.argv) > 4 else 50, throttle_rate=float(sys.argv[5]) if len(sys.argv) > 5 else 0.0)
+        run = benchmark_proxy(trace, os.path.basename(trace_path), int(sys.argv[3]) if len(sys.argv) > 3 else 8, upstream)
+        if run["upstream_stats"]["unexpected"] > 0:
+            sys.exit(1)
+    elif len(sys.argv) > 2 and sys.argv[1] == "trace":
+        with open(sys.argv[2], "w", encoding="utf-8") as f:
+            for entry in sample_trace(int(sys.argv[3]) if len(sys.argv) > 3 else 200):
+                f.write(json.dumps(entry) + "\n")
+    elif len(sys.argv) > 1 and sys.argv[1] == "results":
+        print_results(int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+    else:
+        print("Usage: python benchmark.py paths [iterations] | proxy [trace.jsonl|sample] [concurrency] [latency_ms] [throttle_rate] | trace <out.jsonl> [pages] | results [count]")
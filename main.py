@@ -18,8 +18,49 @@ from urllib import parse
 from tqdm import tqdm
 import re
 import asyncio
+import sqlite3
+import functools
+import codecs
+import hashlib
+import shutil
+import heapq
+import itertools
+import contextlib
+import email.utils
+import logging
+import logging.handlers
+import queue
+import atexit
+import bisect
+import contextvars
+import calendar
+import socket
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import gzip
+try:
+    import fcntl # file locks between worker processes
+except ImportError:
+    fcntl = None
+try:
+    import brotli # optional, pip install brotli to also serve br variants
+except ImportError:
+    brotli = None
 host_address = "192.168.1.101"
 
+# Log records go through a queue to a listener thread, so request handlers never block writing to the terminal. WAYCACHE_LOG_LEVEL=DEBUG shows every request
+log_queue = queue.SimpleQueue()
+log = logging.getLogger("waycache")
+log.setLevel(os.environ.get("WAYCACHE_LOG_LEVEL", "INFO").upper())
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+log.propagate = False
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop) # flush whatever is still queued on exit
+
 def get_spine_key(book):
     spine_keys = {id:(ii,id) for (ii,(id,show)) in enumerate(book.spine)}
     past_end = len(spine_keys)
@@ -28,14 +69,1361 @@ def get_spine_key(book):
 def get_spine_items(book):
     return sorted([get_spine_key(book)(itm) for itm in book.get_items()])
 
-def latency(func, *args, **kwargs):
-    def wrapper(self, *args, **kwargs):
-        start = time.time()
-        func(self, *args, **kwargs)
-        end = time.time()
-        print(f"Function '{func.__name__}' took {end-start} seconds to run.")
+def latency(func):
+    """Decorator that logs how long func takes to run, for plain and async functions"""
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                log.debug("Function '%s' took %.6f seconds to run.", func.__qualname__, time.perf_counter() - start)
+        return async_wrapper
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            log.debug("Function '%s' took %.6f seconds to run.", func.__qualname__, time.perf_counter() - start)
     return wrapper
 
+page_link_pattern = re.compile(r"<(link|script|img|a)\b([^>]*)>", re.IGNORECASE)
+link_attribute_pattern = re.compile(r"\b(href|src)\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.IGNORECASE)
+prefetch_kinds = { # tag -> (priority, accept header a browser would send for it), lower priority goes first
+    "css": (0, "text/css"),
+    "script": (1, "*/*"),
+    "img": (2, "image/avif"),
+    "a": (3, "text/html"),
+}
+
+def extract_page_links(html, page_url, max_page_links:int = 30):
+    """Find the stylesheets, scripts, images and same-site links in a page. Returns a list of (kind, absolute url)"""
+    page_host = (parse.urlsplit(page_url).hostname or "").removeprefix("www.")
+    links = []
+    seen = set()
+    page_links = 0
+    for tag, attributes in page_link_pattern.findall(html):
+        tag = tag.lower()
+        if tag == "link":
+            if "stylesheet" not in attributes.lower():
+                continue
+            tag = "css"
+        attribute = link_attribute_pattern.search(attributes)
+        if attribute is None or attribute.group(1).lower() != ("href" if tag in ("css", "a") else "src"):
+            continue
+        link = (attribute.group(2) or attribute.group(3) or attribute.group(4) or "").strip()
+        if link == "" or link.startswith(("#", "javascript:", "mailto:", "data:")):
+            continue
+        link = parse.urljoin(page_url, link).split("#")[0]
+        if not link.startswith(("http://", "https://")) or link in seen:
+            continue
+        if tag == "a":
+            if (parse.urlsplit(link).hostname or "").removeprefix("www.") != page_host or page_links >= max_page_links:
+                continue
+            page_links += 1
+        seen.add(link)
+        links.append((tag, link))
+    return links
+
+def guess_accept(url, mimetype = None):
+    """Accept header a browser would most likely have sent for url, so bulk-cached files land on the same cache path"""
+    if mimetype is not None and mimetype not in ("-", "unk", "warc/revisit"):
+        if mimetype == "text/html" or mimetype.startswith(("text/css", "image/")):
+            return mimetype.split(";")[0]
+        return "*/*"
+    extension = parse.urlsplit(url).path.rsplit("/", 1)[-1].rsplit(".", 1)
+    extension = extension[1].lower() if len(extension) > 1 else ""
+    if extension in ("", "html", "htm", "php", "asp", "aspx", "jsp", "cgi"):
+        return "text/html"
+    if extension == "css":
+        return "text/css"
+    if extension in ("png", "jpg", "jpeg", "gif"):
+        return "image/" + extension
+    return "*/*"
+
+def read_url_list(list_path):
+    """Read a list of (url, accept) from a plain url list (one per line), a CDX listing (space separated, as saved from the CDX server) or a CDX JSON export"""
+    with open(list_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    urls = []
+    if text.lstrip().startswith("["): # CDX JSON output, first row is the field names
+        rows = json.loads(text)
+        fields = rows[0]
+        for row in rows[1:]:
+            row = dict(zip(fields, row))
+            if row.get("statuscode", "200") in ("200", "-"):
+                urls.append((row["original"], guess_accept(row["original"], row.get("mimetype"))))
+        return urls
+    for line in text.split("\n"):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith("#"):
+            continue
+        if len(fields) >= 3 and fields[1].isdigit() and len(fields[1]) == 14: # CDX line: urlkey timestamp original mimetype statuscode ...
+            if len(fields) >= 5 and fields[4] not in ("200", "-"):
+                continue
+            urls.append((fields[2], guess_accept(fields[2], fields[3] if len(fields) >= 4 else None)))
+        else:
+            url = fields[0]
+            if not url.startswith(("http://", "https://")):
+                url = "http://" + url
+            urls.append((url, guess_accept(url)))
+    return urls
+
+cache_path_special_characters = str.maketrans("", "", ",;:%?&=+#@") # stripped from every part of a cache path
+image_filetypes = frozenset(["png","jpg","jpeg","gif"]) # supported image filetypes
+html_filetypes = frozenset(["html","php"])
+
+@functools.lru_cache(maxsize=65536)
+def normalize_request_url(request_url, host_address, external_ip = ""):
+    """Turn the url a request came in on (direct, through the proxy, or with the proxy's own address in front) into the http:// url being asked for"""
+    for address in (host_address, external_ip):
+        host_address_string = f"http://{address}:8002/"
+        if address != "" and request_url.startswith(host_address_string):
+            request_url = request_url[len(host_address_string):]
+    if request_url.startswith("http:/"):
+        request_url = request_url.replace("http:/","")
+    if request_url.startswith("https:/"):
+        request_url = request_url.replace("https:/","")
+    return "http://" + request_url.lstrip("/")
+
+@functools.lru_cache(maxsize=65536)
+def url_to_cache_path(url, parameters, request_accepts):
+    """Map a url to its place under a cache day directory. Returns (index path, file path, dir path, filename, file_type, file_extension), all relative to the day directory. Pure, so it's memoized; get_url_info adds the day"""
+    if url.startswith("https://web.archive.org/web/"):
+        url = url.replace("https://web.archive.org/web/","") # remove the server url from the beginning of the url if it's there
+    if url.startswith("/"):
+        url = url[1:]
+    assert (url.startswith("http://") or url.startswith("https://")), "URL must start with http:// or https://"
+
+    path_chunks = url.replace("http://","").replace("https://","").split("/")
+    domain_parts = ["domain-"+part for part in path_chunks.pop(0).split(".")]
+    domain_parts[-1] = "tld-" + domain_parts[-1].replace("domain-","")
+    domain_parts.reverse()
+    path_parts = [part.translate(cache_path_special_characters) for part in domain_parts + path_chunks if part != ""] # remove special characters
+    index_path = "/".join(part for part in path_parts if part != "www") # skip www to simulate a real website using www to mirror the non-www version
+
+    # Make sure the path would lead to a file, assume index.html if it's not
+    file_path = index_path
+    if file_path.endswith("/"):
+        file_path += "index.html" if request_accepts == "text/html" else "index."+request_accepts.split("/")[1]
+    elif "." not in file_path: # no file extension
+        file_path += "/index.html" if request_accepts == "text/html" else "."+request_accepts.split("/")[1]
+
+    dir_path, _, filename = file_path.rpartition("/")
+    if dir_path != "" and not dir_path.endswith("/"):
+        dir_path += "/"
+    # Determine the file_type of the path by the filename extension
+    file_extension = filename.split(".")[-1]
+    file_type = "file"
+    if file_extension in html_filetypes:
+        file_type = "html"
+    if file_extension in image_filetypes:
+        file_type = "image"
+    elif file_extension == "css":
+        file_type = "css"
+    for parameter in parameters.split("&"):
+        if parameter == "":
+            continue
+        parameter = parameter.replace("=","--")
+        filename += "." + parameter
+        file_path += "." + parameter
+    return index_path, file_path, dir_path, filename, file_type, file_extension
+
+compressible_extensions = frozenset(["html","htm","php","asp","aspx","jsp","css","js","json","xml","svg","txt"])
+
+def is_compressible(internet_file_path):
+    """Whether a cache path holds text worth precompressing. Query parameters are appended to the filename, so any extension in it counts"""
+    return any(part in compressible_extensions for part in internet_file_path.rsplit("/", 1)[-1].lower().split(".")[1:])
+
+@functools.lru_cache(maxsize=1024)
+def accepted_encodings(accept_encoding):
+    """Encodings we have variants for that an Accept-Encoding header allows, best first"""
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, parameters = item.partition(";")
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip()] = quality
+    return tuple(encoding for encoding in ("br", "gzip") if qualities.get(encoding, qualities.get("*", 0.0)) > 0)
+
+def parse_range(range_header, size):
+    """Parse a single byte range (bytes=0-99, bytes=100- or bytes=-100) into inclusive (start, end), clipped to size. None if it isn't a range we serve, such as several ranges at once. start >= size if it can't be satisfied"""
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in byte_range:
+        return None
+    first, separator, last = byte_range.strip().partition("-")
+    if separator == "":
+        return None
+    try:
+        if first == "": # the last n bytes
+            suffix_length = int(last)
+            return (max(size - suffix_length, 0) if suffix_length > 0 else size), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last != "" else size - 1
+        if start < 0 or (last != "" and int(last) < start):
+            return None
+    except ValueError:
+        return None
+    return start, end
+
+def cache_path_domain(relative_path):
+    """Get the domain a cache path (tld-com/domain-example/...) is for, e.g. example.com"""
+    names = []
+    for part in relative_path.split("/"):
+        if not part.startswith(("tld-", "domain-")):
+            break
+        names.append(part.removeprefix("tld-").removeprefix("domain-"))
+    return ".".join(reversed(names))
+
+def walk_cache_days(cache_dir):
+    """Yield (year, month, day, day directory) for every dated directory in the cache"""
+    for year in os.listdir(cache_dir):
+        if not year.isdigit():
+            continue
+        for month in os.listdir(os.path.join(cache_dir, year)):
+            if not month.isdigit():
+                continue
+            for day in os.listdir(os.path.join(cache_dir, year, month)):
+                if not day.isdigit():
+                    continue
+                yield year, month, day, os.path.join(cache_dir, year, month, day)
+
+def connect_db(db_path, isolation_level = ""):
+    """Open the shared SQLite database in WAL mode. Worker processes share it, so each connection waits for the others' writes instead of failing"""
+    connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=isolation_level)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+class ReadConnection:
+    """A second connection for reads on the request path. In WAL mode readers never wait for writers, so these don't queue behind a write that is itself waiting on another process"""
+    def __init__(self, db_path:str):
+        self.lock = threading.Lock()
+        self.connection = connect_db(db_path)
+
+    def one(self, sql, parameters = ()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchone()
+
+    def all(self, sql, parameters = ()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+class ProcessLock:
+    """Exclusive lock on a lock file, shared between worker processes with flock. Where fcntl isn't available (Windows) it's a no-op, which is fine as long as only one worker runs"""
+    def __init__(self, lock_path:str):
+        self.lock_path = lock_path
+        self.fd = None
+
+    def acquire(self, blocking:bool = True):
+        """Take the lock. Returns False if blocking is False and another process has it"""
+        if fcntl is None:
+            return True
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    async def acquire_async(self, poll_interval:float = 0.1):
+        """Take the lock without blocking the event loop"""
+        while not self.acquire(blocking=False):
+            await asyncio.sleep(poll_interval)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class CacheIndex:
+    """Persistent index of which cache paths exist on which cache dates, so finding the newest cached copy of a URL is one indexed query instead of a walk over every year/month/day directory"""
+    def __init__(self, db_path:str = "cache_index.db"):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = connect_db(db_path)
+        self.reader = ReadConnection(db_path)
+        # Every cached file and every directory above it gets a row, so a lookup matches exactly what os.path.exists() on the cache tree would have
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_paths (path TEXT NOT NULL, date INTEGER NOT NULL, PRIMARY KEY (path, date)) WITHOUT ROWID")
+        # What's stored at each cached file (keyed relative to the cache dir), for validators, accounting and eviction. captured is the Wayback capture timestamp, if known
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_objects (path TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL, captured TEXT, date INTEGER, domain TEXT, last_access REAL, hits INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(cache_objects)")]
+        for column, definition in (("date", "INTEGER"), ("domain", "TEXT"), ("last_access", "REAL"), ("hits", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns: # index from before eviction
+                self.connection.execute(f"ALTER TABLE cache_objects ADD COLUMN {column} {definition}")
+        if "date" not in columns:
+            rows = []
+            for key, in self.connection.execute("SELECT path FROM cache_objects").fetchall():
+                parts = key.split("/", 3)
+                if len(parts) == 4 and parts[0].isdigit() and parts[1].isdigit() and parts[2].isdigit():
+                    rows.append((self.date_key(parts[0], parts[1], parts[2]), cache_path_domain(parts[3]), key))
+            self.connection.executemany("UPDATE cache_objects SET date = ?, domain = ? WHERE path = ?", rows)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_objects_digest ON cache_objects (digest)")
+        self.connection.commit()
+        self.accesses = {} # object key -> (last access, hits) not written to the database yet
+
+    @staticmethod
+    def date_key(year, month, day):
+        return int(year) * 10000 + int(month) * 100 + int(day) # YYYYMMDD
+
+    @staticmethod
+    def path_rows(relative_path, date):
+        rows = []
+        parts = [part for part in relative_path.split("/") if part != ""]
+        for i in range(len(parts)):
+            rows.append(("/".join(parts[:i+1]), date))
+        return rows
+
+    def split_cache_path(self, cache_dir, internet_file_path):
+        """Split ./cache/<year>/<month>/<day>/<relative path> into (date key, relative path), or None if the path isn't a dated cache path"""
+        relative = os.path.relpath(internet_file_path, cache_dir).replace(os.sep, "/")
+        parts = relative.split("/", 3)
+        if len(parts) < 4 or not (parts[0].isdigit() and parts[1].isdigit() and parts[2].isdigit()):
+            return None
+        return self.date_key(parts[0], parts[1], parts[2]), parts[3]
+
+    def add_file(self, cache_dir, internet_file_path, digest = None, size = None, captured = None):
+        split_path = self.split_cache_path(cache_dir, internet_file_path)
+        if split_path is None:
+            return
+        date, relative_path = split_path
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO cache_paths (path, date) VALUES (?, ?)", self.path_rows(relative_path, date))
+            if digest is not None:
+                self.connection.execute("INSERT OR REPLACE INTO cache_objects (path, digest, size, captured, date, domain, last_access, hits) VALUES (?, ?, ?, ?, ?, ?, ?, 0)", (self.object_key(cache_dir, internet_file_path), digest, size, captured, date, cache_path_domain(relative_path), time.time()))
+
+    def remove_file(self, cache_dir, internet_file_path):
+        """Drop a cached file from the index, along with the directory rows above it that have nothing else under them on that date"""
+        split_path = self.split_cache_path(cache_dir, internet_file_path)
+        if split_path is None:
+            return
+        date, relative_path = split_path
+        parts = relative_path.split("/")
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache_objects WHERE path = ?", (self.object_key(cache_dir, internet_file_path),))
+            for i in range(len(parts), 0, -1):
+                ancestor = "/".join(parts[:i])
+                if i < len(parts) and self.connection.execute("SELECT 1 FROM cache_paths WHERE path > ? AND path < ? AND date = ? LIMIT 1", (ancestor + "/", ancestor + "0", date)).fetchone() is not None:
+                    break # still has other files under it
+                self.connection.execute("DELETE FROM cache_paths WHERE path = ? AND date = ?", (ancestor, date))
+
+    def touch(self, cache_dir, internet_file_path):
+        """Note an access to a cached file. Kept in memory until flush_accesses, so serving never writes to the database"""
+        key = self.object_key(cache_dir, internet_file_path)
+        hits = self.accesses.get(key, (0, 0))[1]
+        self.accesses[key] = (time.time(), hits + 1)
+
+    def take_accesses(self):
+        accesses, self.accesses = self.accesses, {}
+        return accesses
+
+    def flush_accesses(self, accesses):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE cache_objects SET last_access = ?, hits = hits + ? WHERE path = ?", [(last_access, hits, key) for key, (last_access, hits) in accesses.items()])
+
+    def object_keys(self):
+        with self.lock:
+            return set(row[0] for row in self.connection.execute("SELECT path FROM cache_objects"))
+
+    def stored_bytes(self):
+        """Bytes the cached bodies take up, counting each distinct body once like the blob store and packs do"""
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM cache_objects GROUP BY digest)").fetchone()[0]
+
+    def eviction_candidates(self, oldest_date, newest_date, policy, limit):
+        """Get (key, digest, size) of the cached files least worth keeping: ones on dates outside (oldest_date, newest_date] first, then by policy"""
+        order = "hits ASC, COALESCE(last_access, 0) ASC" if policy == "lfu" else "COALESCE(last_access, 0) ASC"
+        with self.lock:
+            return self.connection.execute(f"SELECT path, digest, size FROM cache_objects ORDER BY (date > ? AND date <= ?) ASC, {order} LIMIT ?", (oldest_date, newest_date, limit)).fetchall()
+
+    def digest_referenced(self, digest):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM cache_objects WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+    def usage_by(self, column, limit:int = 100):
+        """Get {domain or date: {"objects", "bytes"}} for the biggest users of the cache. Bytes are before deduplication"""
+        assert column in ("domain", "date")
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {column}, COUNT(*), SUM(size) FROM cache_objects GROUP BY {column} ORDER BY SUM(size) DESC LIMIT ?", (limit,)).fetchall()
+        usage = {}
+        for key, count, size in rows:
+            if column == "date" and key is not None:
+                key = f"{key // 10000:04d}-{key // 100 % 100:02d}-{key % 100:02d}"
+            usage[str(key)] = {"objects": count, "bytes": size}
+        return usage
+
+    @staticmethod
+    def object_key(cache_dir, internet_file_path):
+        if internet_file_path.startswith(cache_dir + "/"): # how get_url_info builds them, skip relpath's normalizing on the hot path
+            return internet_file_path[len(cache_dir) + 1:]
+        return os.path.relpath(internet_file_path, cache_dir).replace(os.sep, "/")
+
+    def object_info(self, cache_dir, internet_file_path):
+        """Get (digest, size, captured) for a cached file, or None if it was cached before objects were recorded"""
+        return self.reader.one("SELECT digest, size, captured FROM cache_objects WHERE path = ?", (self.object_key(cache_dir, internet_file_path),))
+
+    def newest_date(self, relative_path, oldest_date, newest_date):
+        """Get the newest date key in (oldest_date, newest_date] that has relative_path cached, or None"""
+        row = self.reader.one("SELECT MAX(date) FROM cache_paths WHERE path = ? AND date > ? AND date <= ?", (relative_path.strip("/"), oldest_date, newest_date))
+        return row[0] if row is not None else None
+
+    def rebuild(self, cache_dir, packed_paths = ()):
+        """Rebuild the whole index from the files currently in the cache directory, plus any cache paths (relative to cache_dir) stored in packs"""
+        print("Rebuilding cache index from:", cache_dir)
+        rows = []
+        file_count = 0
+        for packed_path in packed_paths:
+            split_path = self.split_cache_path(cache_dir, os.path.join(cache_dir, packed_path))
+            if split_path is not None:
+                rows += self.path_rows(split_path[1], split_path[0])
+                file_count += 1
+        object_keys = set(packed_paths)
+        for year, month, day, day_dir in walk_cache_days(cache_dir):
+            date = self.date_key(year, month, day)
+            for root, dirs, files in os.walk(day_dir):
+                files = [name for name in files if not name.endswith(".part")] # skip downloads that never finished
+                for name in dirs + files:
+                    relative_path = os.path.relpath(os.path.join(root, name), day_dir).replace(os.sep, "/")
+                    rows.append((relative_path, date))
+                for name in files:
+                    object_keys.add(self.object_key(cache_dir, os.path.join(root, name)))
+                file_count += len(files)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache_paths")
+            self.connection.executemany("INSERT OR IGNORE INTO cache_paths (path, date) VALUES (?, ?)", rows)
+            stale_objects = [(path,) for path, in self.connection.execute("SELECT path FROM cache_objects") if path not in object_keys]
+            self.connection.executemany("DELETE FROM cache_objects WHERE path = ?", stale_objects)
+        print("Cache index rebuilt:", file_count, "files,", len(rows), "paths.")
+
+class BlobStore:
+    """Content-addressed storage for cached bodies. Each unique body is stored once under blobs/<sha256>, and every dated cache path that has that body is a hardlink to it, so the same sprite cached under a hundred proxy dates only takes up disk space once"""
+    def __init__(self, blob_dir:str):
+        self.blob_dir = blob_dir
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def store(self, temp_file_path, internet_file_path, digest):
+        """Move a finished download into the blob store and point internet_file_path at it"""
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(temp_file_path) # already have this body
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_file_path, blob_path)
+        self.link(blob_path, internet_file_path)
+
+    def link(self, blob_path, internet_file_path):
+        temp_link_path = f"{internet_file_path}.{uuid.uuid4().hex}.part"
+        try:
+            os.link(blob_path, temp_link_path)
+        except OSError: # filesystem without hardlinks, fall back to a plain copy
+            shutil.copyfile(blob_path, temp_link_path)
+        os.replace(temp_link_path, internet_file_path) # atomic, readers see the old file or the whole new one
+
+    @staticmethod
+    def hash_file(file_path):
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def migrate(self, cache_dir):
+        """Convert a cache tree of plain files into blobs and hardlinks"""
+        print("Deduplicating cache:", cache_dir)
+        converted = 0
+        for year, month, day, day_dir in tqdm(list(walk_cache_days(cache_dir))):
+            for root, dirs, files in os.walk(day_dir):
+                for name in files:
+                    if name.endswith(".part"):
+                        continue
+                    file_path = os.path.join(root, name)
+                    blob_path = self.blob_path(self.hash_file(file_path))
+                    if os.path.exists(blob_path):
+                        if not os.path.samefile(blob_path, file_path):
+                            self.link(blob_path, file_path)
+                            converted += 1
+                    else: # first copy of this body becomes the blob
+                        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                        try:
+                            os.link(file_path, blob_path)
+                        except OSError:
+                            shutil.copyfile(file_path, blob_path)
+                        converted += 1
+        print("Converted", converted, "files.")
+        self.print_report()
+
+    def report(self):
+        """Count blobs, the cache paths pointing at them and the bytes saved by not storing duplicates"""
+        report = {"blobs": 0, "cache_paths": 0, "stored_bytes": 0, "logical_bytes": 0, "saved_bytes": 0}
+        for root, dirs, files in os.walk(self.blob_dir):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                references = max(stat.st_nlink - 1, 0) # every link except the blob itself is a cache path
+                report["blobs"] += 1
+                report["cache_paths"] += references
+                report["stored_bytes"] += stat.st_size
+                report["logical_bytes"] += stat.st_size * references
+                report["saved_bytes"] += stat.st_size * max(references - 1, 0)
+        return report
+
+    def print_report(self):
+        report = self.report()
+        print(f"Blobs: {report['blobs']} | Cache paths: {report['cache_paths']} | Stored: {report['stored_bytes']} bytes | Without dedup: {report['logical_bytes']} bytes | Saved: {report['saved_bytes']} bytes")
+
+class PackStore:
+    """Optional storage backend that appends cached bodies to a few large pack files instead of keeping one small file per object.
+    Each record in a pack is a header line ("WBPACK <sha256> <length>\\n") followed by the body, and an offset index in SQLite maps cache paths to records, so a hit is a single os.pread on an already open pack"""
+    def __init__(self, pack_dir:str, db_path:str = "cache_index.db", max_pack_size:int = 1024 * 1024 * 1024):
+        self.pack_dir = pack_dir
+        self.temp_dir = os.path.join(pack_dir, "tmp")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.max_pack_size = max_pack_size
+        self.lock = threading.Lock()
+        self.connection = connect_db(db_path)
+        self.reader = ReadConnection(db_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pack_objects (digest TEXT PRIMARY KEY, pack INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pack_paths (path TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+        self.connection.commit()
+        self.read_fds = {} # pack number -> fd, kept open so reads never open anything
+        self.append_lock = ProcessLock(os.path.join(pack_dir, "append.lock")) # other worker processes append to the same packs
+        self.append_mutex = threading.Lock() # and so do this process's fetch threads, which share append_lock's fd
+        packs = self.pack_numbers()
+        self.current_pack = packs[-1] if packs else 1
+
+    def pack_numbers(self):
+        return sorted(int(name[5:-5]) for name in os.listdir(self.pack_dir) if name.startswith("pack-") and name.endswith(".pack"))
+
+    def pack_path(self, pack):
+        return os.path.join(self.pack_dir, f"pack-{pack:06d}.pack")
+
+    def read_fd(self, pack):
+        fd = self.read_fds.get(pack)
+        if fd is None:
+            fd = os.open(self.pack_path(pack), os.O_RDONLY)
+            self.read_fds[pack] = fd
+        return fd
+
+    def close_read_fds(self):
+        for fd in self.read_fds.values():
+            os.close(fd)
+        self.read_fds = {}
+
+    def lookup(self, key):
+        """Get (pack, offset, length) for a cache path, or None if it isn't packed"""
+        return self.reader.one("SELECT pack_objects.pack, pack_objects.offset, pack_objects.length FROM pack_paths JOIN pack_objects ON pack_objects.digest = pack_paths.digest WHERE pack_paths.path = ?", (key,))
+
+    def read(self, key, start:int = 0, length:int = None):
+        record = self.lookup(key)
+        if record is None:
+            raise FileNotFoundError(key)
+        pack, offset, object_length = record
+        if length is None:
+            length = object_length - start
+        return os.pread(self.read_fd(pack), max(0, min(length, object_length - start)), offset + start)
+
+    def append(self, source_file, digest, length):
+        """Append a record to the current pack, rolling over to a new pack when it gets too big. Returns (pack, offset of the body). Caller holds append_mutex and the append lock"""
+        packs = self.pack_numbers()
+        if packs and packs[-1] > self.current_pack: # another worker rolled over
+            self.current_pack = packs[-1]
+        pack_path = self.pack_path(self.current_pack)
+        if os.path.exists(pack_path) and os.path.getsize(pack_path) + length > self.max_pack_size:
+            self.current_pack += 1
+            pack_path = self.pack_path(self.current_pack)
+        header = f"WBPACK {digest} {length}\n".encode("ascii")
+        with open(pack_path, "ab") as f:
+            offset = f.tell() + len(header)
+            f.write(header)
+            shutil.copyfileobj(source_file, f, 1024 * 1024)
+        return self.current_pack, offset
+
+    def add(self, key, temp_file_path, digest):
+        """Move a finished download into the packs under key. The lock is only held for the SQL, so lookups never wait on a body being copied or on another process's append"""
+        length = os.path.getsize(temp_file_path)
+        with self.append_mutex, self.append_lock:
+            with self.lock:
+                packed = self.connection.execute("SELECT 1 FROM pack_objects WHERE digest = ?", (digest,)).fetchone() is not None # identical bodies are only packed once
+            if not packed:
+                with open(temp_file_path, "rb") as f:
+                    pack, offset = self.append(f, digest, length)
+                with self.lock, self.connection:
+                    self.connection.execute("INSERT INTO pack_objects (digest, pack, offset, length) VALUES (?, ?, ?, ?)", (digest, pack, offset, length))
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pack_paths (path, digest) VALUES (?, ?)", (key, digest))
+        os.remove(temp_file_path)
+
+    def add_reference(self, key, digest):
+        """Point key at an object that's already packed. Returns False if there's no such object"""
+        with self.lock, self.connection:
+            if self.connection.execute("SELECT 1 FROM pack_objects WHERE digest = ?", (digest,)).fetchone() is None:
+                return False
+            self.connection.execute("INSERT OR REPLACE INTO pack_paths (path, digest) VALUES (?, ?)", (key, digest))
+        return True
+
+    def remove(self, key):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM pack_paths WHERE path = ?", (key,))
+
+    def paths(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT path FROM pack_paths")]
+
+    def digests(self):
+        with self.lock:
+            return self.connection.execute("SELECT path, digest FROM pack_paths").fetchall()
+
+    def objects(self):
+        """Get (path, digest, length) of everything packed"""
+        with self.lock:
+            return self.connection.execute("SELECT pack_paths.path, pack_paths.digest, pack_objects.length FROM pack_paths JOIN pack_objects ON pack_objects.digest = pack_paths.digest").fetchall()
+
+    def repack(self):
+        """Rewrite every object that is still referenced into fresh packs and delete the old ones, dropping unreferenced objects"""
+        old_packs = self.pack_numbers()
+        with self.append_mutex, self.append_lock, self.lock:
+            live = self.connection.execute("SELECT digest, pack, offset, length FROM pack_objects WHERE digest IN (SELECT digest FROM pack_paths) ORDER BY pack, offset").fetchall()
+            self.current_pack = (old_packs[-1] + 1) if old_packs else 1
+            moved = []
+            for digest, pack, offset, length in tqdm(live):
+                temp_file_path = os.path.join(self.temp_dir, f"{uuid.uuid4().hex}.part")
+                with open(temp_file_path, "wb") as f:
+                    f.write(os.pread(self.read_fd(pack), length, offset))
+                with open(temp_file_path, "rb") as f:
+                    moved.append((digest,) + self.append(f, digest, length) + (length,))
+                os.remove(temp_file_path)
+            with self.connection:
+                self.connection.execute("DELETE FROM pack_objects")
+                self.connection.executemany("INSERT INTO pack_objects (digest, pack, offset, length) VALUES (?, ?, ?, ?)", moved)
+            self.close_read_fds()
+            for pack in old_packs:
+                os.remove(self.pack_path(pack))
+        print("Repacked", len(live), "objects from", len(old_packs), "packs into", len(self.pack_numbers()), "packs.")
+
+    def convert(self, cache_dir):
+        """Move every file in the dated cache directories into packs and remove the files"""
+        print("Converting cache to packs:", cache_dir)
+        converted = 0
+        for year, month, day, day_dir in tqdm(list(walk_cache_days(cache_dir))):
+            for root, dirs, files in os.walk(day_dir, topdown=False):
+                for name in files:
+                    file_path = os.path.join(root, name)
+                    if name.endswith(".part"):
+                        os.remove(file_path)
+                        continue
+                    temp_file_path = os.path.join(self.temp_dir, f"{uuid.uuid4().hex}.part")
+                    os.replace(file_path, temp_file_path)
+                    self.add(os.path.relpath(file_path, cache_dir).replace(os.sep, "/"), temp_file_path, BlobStore.hash_file(temp_file_path))
+                    converted += 1
+                if not os.listdir(root):
+                    os.rmdir(root)
+        # blobs whose only remaining link is the blob itself were only referenced by the files just packed
+        blob_dir = os.path.join(cache_dir, "blobs")
+        if os.path.exists(blob_dir):
+            for root, dirs, files in os.walk(blob_dir):
+                for name in files:
+                    if os.stat(os.path.join(root, name)).st_nlink == 1:
+                        os.remove(os.path.join(root, name))
+        print("Packed", converted, "files into", len(self.pack_numbers()), "packs.")
+
+class VariantStore:
+    """Precompressed gzip (and brotli, if it's installed) copies of cached text, built once per body and stored by digest under variants/, so serving them costs no compression CPU. The cache_variants table is joined through cache_objects, so when a path is rewritten or removed its variants go with it"""
+    def __init__(self, variant_dir:str, db_path:str = "cache_index.db", min_size:int = 1024, max_size:int = 16 * 1024 * 1024):
+        self.variant_dir = variant_dir
+        self.min_size = min_size # smaller bodies aren't worth a second round trip to disk
+        self.max_size = max_size
+        self.encodings = ("gzip", "br") if brotli is not None else ("gzip",)
+        os.makedirs(self.variant_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = connect_db(db_path)
+        self.reader = ReadConnection(db_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_variants (digest TEXT NOT NULL, encoding TEXT NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (digest, encoding)) WITHOUT ROWID")
+        self.connection.commit()
+        self.stats = {"built": 0, "not_worth_it": 0, "served": 0}
+
+    def variant_path(self, digest, encoding):
+        return os.path.join(self.variant_dir, digest[:2], f"{digest}.{encoding}")
+
+    def lookup(self, object_key):
+        """Get {encoding: (variant path, size)} for a cached path"""
+        rows = self.reader.all("SELECT cache_variants.digest, cache_variants.encoding, cache_variants.size FROM cache_objects JOIN cache_variants ON cache_variants.digest = cache_objects.digest WHERE cache_objects.path = ?", (object_key,))
+        return {encoding: (self.variant_path(digest, encoding), size) for digest, encoding, size in rows}
+
+    def has_variants(self, digest):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM cache_variants WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+    def build(self, digest, body):
+        """Compress body into every supported encoding. Variants that don't save at least a tenth are skipped. Returns the encodings built"""
+        if len(body) < self.min_size or len(body) > self.max_size or self.has_variants(digest):
+            return []
+        built = []
+        for encoding in self.encodings:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0) if encoding == "gzip" else brotli.compress(body, quality=11)
+            if len(compressed) > len(body) * 0.9:
+                self.stats["not_worth_it"] += 1
+                continue
+            variant_path = self.variant_path(digest, encoding)
+            os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+            temp_file_path = f"{variant_path}.{uuid.uuid4().hex}.part"
+            with open(temp_file_path, "wb") as f:
+                f.write(compressed)
+            os.replace(temp_file_path, variant_path)
+            with self.lock, self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO cache_variants (digest, encoding, size) VALUES (?, ?, ?)", (digest, encoding, len(compressed)))
+            built.append(encoding)
+            self.stats["built"] += 1
+        return built
+
+    def remove(self, digest):
+        """Delete every variant of a body. Returns the bytes freed"""
+        with self.lock, self.connection:
+            rows = self.connection.execute("SELECT encoding, size FROM cache_variants WHERE digest = ?", (digest,)).fetchall()
+            self.connection.execute("DELETE FROM cache_variants WHERE digest = ?", (digest,))
+        for encoding, size in rows:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.variant_path(digest, encoding))
+        return sum(size for encoding, size in rows)
+
+    def stored_bytes(self):
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache_variants").fetchone()[0]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        with self.lock:
+            for encoding, count, size in self.connection.execute("SELECT encoding, COUNT(*), SUM(size) FROM cache_variants GROUP BY encoding"):
+                stats[encoding] = {"variants": count, "bytes": size}
+        return stats
+
+class RateLimiter:
+    """Token bucket and concurrency cap per upstream host. Backs off when a host answers 429/503 (honouring Retry-After) and creeps back up to the configured rate as requests succeed"""
+    def __init__(self, host_limits:dict = None, default_limits:dict = None, shared_db_path:str = None):
+        self.host_limits = host_limits or {}
+        self.default_limits = default_limits or {"rate": 4, "burst": 8, "concurrency": 4}
+        self.min_rate = 0.05 # never slow down past one request every 20 seconds
+        self.default_backoff = 10 # seconds to pause a host that throttles us without a Retry-After
+        self.hosts = {}
+        self.shared_connection = None
+        if shared_db_path is not None: # several worker processes, so the buckets live in SQLite where they all take from the same one
+            self.shared_lock = threading.Lock()
+            self.shared_connection = connect_db(shared_db_path, isolation_level=None)
+            self.shared_connection.execute("CREATE TABLE IF NOT EXISTS rate_buckets (host TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, rate REAL NOT NULL, backoff_until REAL NOT NULL)")
+
+    def host_state(self, host):
+        if host not in self.hosts:
+            limits = dict(self.default_limits)
+            limits.update(self.host_limits.get(host, {}))
+            self.hosts[host] = {
+                "host": host,
+                "max_rate": limits["rate"], # requests per second when the host is happy
+                "rate": limits["rate"], # current requests per second
+                "burst": limits["burst"],
+                "tokens": limits["burst"],
+                "updated": time.monotonic(),
+                "backoff_until": 0,
+                "semaphore": asyncio.Semaphore(limits["concurrency"]),
+                "concurrency": limits["concurrency"],
+                "waiting": 0, # queue depth
+                "active": 0,
+                "completed": 0,
+                "throttled": 0,
+                "errors": 0,
+                "recent": deque(), # completion times in the last minute, for throughput
+            }
+        return self.hosts[host]
+
+    def take_shared_token(self, host, state):
+        """Take a token from host's bucket in the shared database. Returns 0 if we got one, else how long to wait before trying again"""
+        with self.shared_lock:
+            self.shared_connection.execute("BEGIN IMMEDIATE") # one worker at a time reads and updates a bucket
+            try:
+                now = time.time()
+                self.shared_connection.execute("INSERT OR IGNORE INTO rate_buckets (host, tokens, updated, rate, backoff_until) VALUES (?, ?, ?, ?, 0)", (host, state["burst"], now, state["max_rate"]))
+                tokens, updated, rate, backoff_until = self.shared_connection.execute("SELECT tokens, updated, rate, backoff_until FROM rate_buckets WHERE host = ?", (host,)).fetchone()
+                state["rate"] = rate
+                tokens = min(state["burst"], tokens + max(0, now - updated) * rate)
+                if now < backoff_until:
+                    wait = backoff_until - now
+                elif tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / rate
+                self.shared_connection.execute("UPDATE rate_buckets SET tokens = ?, updated = ? WHERE host = ?", (tokens, now, host))
+                self.shared_connection.execute("COMMIT")
+            except BaseException:
+                self.shared_connection.execute("ROLLBACK")
+                raise
+        state["tokens"] = tokens
+        return wait
+
+    def report_shared(self, host, state, throttled_until = None):
+        """Share a rate change (and any backoff) from report() with the other workers"""
+        with self.shared_lock:
+            self.shared_connection.execute("UPDATE rate_buckets SET rate = ?, backoff_until = MAX(backoff_until, ?), tokens = CASE WHEN ? > 0 THEN 0 ELSE tokens END WHERE host = ?", (state["rate"], throttled_until or 0, throttled_until or 0, host))
+
+    async def take_token(self, state):
+        if self.shared_connection is not None:
+            while True:
+                wait = await asyncio.to_thread(self.take_shared_token, state["host"], state)
+                if wait == 0:
+                    return
+                await asyncio.sleep(wait)
+        while True:
+            now = time.monotonic()
+            if now < state["backoff_until"]:
+                await asyncio.sleep(state["backoff_until"] - now)
+                continue
+            state["tokens"] = min(state["burst"], state["tokens"] + (now - state["updated"]) * state["rate"])
+            state["updated"] = now
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return
+            await asyncio.sleep((1 - state["tokens"]) / state["rate"])
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host):
+        """Wait for a free connection slot and a token for host, and hold the slot while the request runs"""
+        state = self.host_state(host)
+        state["waiting"] += 1
+        try:
+            await state["semaphore"].acquire()
+            try:
+                await self.take_token(state)
+            except BaseException:
+                state["semaphore"].release()
+                raise
+        finally:
+            state["waiting"] -= 1
+        state["active"] += 1
+        try:
+            yield state
+        finally:
+            state["active"] -= 1
+            state["completed"] += 1
+            state["recent"].append(time.monotonic())
+            state["semaphore"].release()
+
+    def report(self, host, status_code, retry_after = None):
+        """Adjust host's rate from a response status (None for a connection error)"""
+        state = self.host_state(host)
+        if status_code in (429, 503):
+            state["throttled"] += 1
+            delay = self.parse_retry_after(retry_after)
+            if delay is None:
+                delay = self.default_backoff
+            state["backoff_until"] = max(state["backoff_until"], time.monotonic() + delay)
+            state["rate"] = max(self.min_rate, state["rate"] / 2)
+            state["tokens"] = 0
+            log.warning("Upstream %s throttled us (%s), backing off %ss, rate now %.2f/s", host, status_code, delay, state["rate"])
+            if self.shared_connection is not None:
+                self.report_shared(host, state, time.time() + delay)
+            return
+        if status_code is None:
+            state["errors"] += 1
+            state["rate"] = max(self.min_rate, state["rate"] * 0.75)
+        elif state["rate"] >= state["max_rate"]:
+            return
+        else:
+            state["rate"] = min(state["max_rate"], state["rate"] + state["max_rate"] * 0.1) # additive recovery back to the configured rate
+        if self.shared_connection is not None:
+            self.report_shared(host, state)
+
+    @staticmethod
+    def parse_retry_after(retry_after):
+        if retry_after is None:
+            return None
+        retry_after = retry_after.strip()
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(0, (retry_date - datetime.datetime.now(retry_date.tzinfo)).total_seconds())
+
+    def get_stats(self):
+        stats = {}
+        now = time.monotonic()
+        for host, state in self.hosts.items():
+            while state["recent"] and state["recent"][0] < now - 60:
+                state["recent"].popleft()
+            stats[host] = {
+                "rate": round(state["rate"], 3),
+                "max_rate": state["max_rate"],
+                "tokens": round(min(state["burst"], state["tokens"] + (now - state["updated"]) * state["rate"]), 3),
+                "concurrency": state["concurrency"],
+                "active": state["active"],
+                "queue_depth": state["waiting"],
+                "completed": state["completed"],
+                "throughput_per_minute": len(state["recent"]),
+                "throttled": state["throttled"],
+                "errors": state["errors"],
+                "backoff_remaining": round(max(0, state["backoff_until"] - now), 3),
+            }
+        return stats
+
+class SnapshotIndex:
+    """Local copy of the Wayback CDX listing for the urls we've served. It resolves (url, proxy date) to the nearest concrete capture without a redirect round trip, and remembers which blob each capture was stored as, so a capture fetched once is reused for every proxy date that resolves to it"""
+    def __init__(self, db_path:str = "cache_index.db", window_days:int = 365, list_ttl_days:int = 30, wayback_url:str = "https://web.archive.org"):
+        self.wayback_url = wayback_url
+        self.window_days = window_days # how far either side of the proxy date each CDX lookup covers
+        self.list_ttl = list_ttl_days * 24 * 60 * 60 # refresh a url's capture list after this long, in case it has been archived since
+        self.lock = threading.Lock()
+        self.connection = connect_db(db_path)
+        self.reader = ReadConnection(db_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snapshot_lists (url TEXT NOT NULL, from_timestamp TEXT NOT NULL, to_timestamp TEXT NOT NULL, fetched REAL NOT NULL, PRIMARY KEY (url, from_timestamp)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snapshots (url TEXT NOT NULL, timestamp TEXT NOT NULL, PRIMARY KEY (url, timestamp)) WITHOUT ROWID")
+        if "kind" not in [row[1] for row in self.connection.execute("PRAGMA table_info(captures)")]: # older captures don't say whether the body was rewritten, so they can't be reused safely
+            self.connection.execute("DROP TABLE IF EXISTS captures")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS captures (url TEXT NOT NULL, timestamp TEXT NOT NULL, kind TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (url, timestamp, kind)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS resolutions (url TEXT NOT NULL, wayback_timestamp TEXT NOT NULL, capture_timestamp TEXT NOT NULL, PRIMARY KEY (url, wayback_timestamp)) WITHOUT ROWID")
+        self.connection.commit()
+        self.resolved = {} # url -> {wayback timestamp: capture timestamp}
+        self.max_resolved = 100000
+        self.stats = {"cdx_lookups": 0, "resolved": 0, "unresolved": 0, "reused_captures": 0}
+
+    def window(self, wayback_timestamp):
+        date = datetime.datetime.strptime(wayback_timestamp[:8], "%Y%m%d")
+        return (date - datetime.timedelta(days=self.window_days)).strftime("%Y%m%d000000"), (date + datetime.timedelta(days=self.window_days)).strftime("%Y%m%d235959")
+
+    def has_list(self, url, wayback_timestamp):
+        """Whether we have a fresh capture list for url that covers wayback_timestamp"""
+        row = self.reader.one("SELECT 1 FROM snapshot_lists WHERE url = ? AND from_timestamp <= ? AND to_timestamp >= ? AND fetched > ? LIMIT 1", (url, wayback_timestamp, wayback_timestamp, time.time() - self.list_ttl))
+        return row is not None
+
+    def cdx_url(self, url, wayback_timestamp):
+        from_timestamp, to_timestamp = self.window(wayback_timestamp)
+        return f"{self.wayback_url}/cdx/search/cdx?" + parse.urlencode({
+            "url": url,
+            "from": from_timestamp,
+            "to": to_timestamp,
+            "output": "json",
+            "fl": "timestamp",
+            "filter": "statuscode:200",
+            "collapse": "timestamp:10", # at most one capture an hour is plenty to pick the nearest from
+        })
+
+    def add_list(self, url, wayback_timestamp, cdx_json):
+        """Store the captures from a CDX JSON response for the window around wayback_timestamp"""
+        rows = json.loads(cdx_json) if cdx_json.strip() != "" else []
+        timestamps = [row[0] for row in rows[1:]] # first row is the field names
+        from_timestamp, to_timestamp = self.window(wayback_timestamp)
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO snapshots (url, timestamp) VALUES (?, ?)", [(url, timestamp) for timestamp in timestamps])
+            self.connection.execute("INSERT OR REPLACE INTO snapshot_lists (url, from_timestamp, to_timestamp, fetched) VALUES (?, ?, ?, ?)", (url, from_timestamp, to_timestamp, time.time()))
+        self.resolved.pop(url, None) # the new list may have a nearer capture
+        self.stats["cdx_lookups"] += 1
+
+    def nearest(self, url, wayback_timestamp):
+        """Get the capture timestamp of url closest to wayback_timestamp, like the Wayback Machine's own redirect would pick, or None"""
+        if wayback_timestamp in self.resolved.get(url, {}):
+            return self.resolved[url][wayback_timestamp]
+        key = (url, wayback_timestamp)
+        before = self.reader.one("SELECT timestamp FROM snapshots WHERE url = ? AND timestamp <= ? ORDER BY timestamp DESC LIMIT 1", key)
+        after = self.reader.one("SELECT timestamp FROM snapshots WHERE url = ? AND timestamp >= ? ORDER BY timestamp ASC LIMIT 1", key)
+        candidates = [row[0] for row in (before, after) if row is not None]
+        if not candidates:
+            self.stats["unresolved"] += 1
+            return None
+        target = datetime.datetime.strptime(wayback_timestamp, "%Y%m%d%H%M%S")
+        capture_timestamp = min(candidates, key=lambda timestamp: abs(datetime.datetime.strptime(timestamp, "%Y%m%d%H%M%S") - target))
+        self.remember(url, wayback_timestamp, capture_timestamp)
+        self.stats["resolved"] += 1
+        return capture_timestamp
+
+    def remember(self, url, wayback_timestamp, capture_timestamp):
+        if len(self.resolved) >= self.max_resolved:
+            self.resolved.clear()
+        self.resolved.setdefault(url, {})[wayback_timestamp] = capture_timestamp
+
+    def resolution(self, url, wayback_timestamp):
+        """The capture Wayback's own redirect picked for url at wayback_timestamp, if we've fetched it before, or None"""
+        row = self.reader.one("SELECT capture_timestamp FROM resolutions WHERE url = ? AND wayback_timestamp = ?", (url, wayback_timestamp))
+        return row[0] if row is not None else None
+
+    def add_resolution(self, url, wayback_timestamp, capture_timestamp):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO snapshots (url, timestamp) VALUES (?, ?)", (url, capture_timestamp))
+            self.connection.execute("INSERT OR REPLACE INTO resolutions (url, wayback_timestamp, capture_timestamp) VALUES (?, ?, ?)", (url, wayback_timestamp, capture_timestamp))
+        self.remember(url, wayback_timestamp, capture_timestamp)
+
+    def add_capture(self, url, timestamp, kind, digest):
+        """Record the digest of a stored capture. kind is "html" for a rewritten page body and "raw" for one stored as downloaded, so one never stands in for the other"""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO snapshots (url, timestamp) VALUES (?, ?)", (url, timestamp))
+            self.connection.execute("INSERT OR REPLACE INTO captures (url, timestamp, kind, digest) VALUES (?, ?, ?, ?)", (url, timestamp, kind, digest))
+        self.resolved.pop(url, None)
+
+    def remove_digest(self, digest):
+        """Forget stored captures whose body is gone, so nothing tries to reuse them"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM captures WHERE digest = ?", (digest,))
+
+    def capture_digest(self, url, timestamp, kind):
+        row = self.reader.one("SELECT digest FROM captures WHERE url = ? AND timestamp = ? AND kind = ?", (url, timestamp, kind))
+        return row[0] if row is not None else None
+
+    def has_captures(self, url, kind):
+        row = self.reader.one("SELECT 1 FROM captures WHERE url = ? AND kind = ? LIMIT 1", (url, kind))
+        return row is not None
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        with self.lock:
+            stats["urls"] = self.connection.execute("SELECT COUNT(DISTINCT url) FROM snapshot_lists").fetchone()[0]
+            stats["captures_stored"] = self.connection.execute("SELECT COUNT(*) FROM captures").fetchone()[0]
+            stats["redirects_recorded"] = self.connection.execute("SELECT COUNT(*) FROM resolutions").fetchone()[0]
+        return stats
+
+class NegativeCache:
+    """URLs that recently failed to load, with how long to keep refusing them based on why they failed. Entries live in SQLite and are loaded into a dict at startup so lookups are O(1)"""
+    def __init__(self, db_path:str = "cache_index.db"):
+        self.ttls = { # seconds to remember a failure, by status class
+            "404": 30 * 24 * 60 * 60, # not archived, unlikely to change soon
+            "410": 30 * 24 * 60 * 60,
+            "429": 5 * 60, # rate limited, nothing wrong with the url
+            "4xx": 7 * 24 * 60 * 60,
+            "5xx": 60 * 60, # upstream trouble, try again later
+            "error": 10 * 60, # timeouts and connection errors
+        }
+        self.lock = threading.Lock()
+        self.connection = connect_db(db_path)
+        self.reader = ReadConnection(db_path)
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE") # worker processes start together, only one of them migrates
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(negative_cache)")]
+            if columns and "seq" not in columns: # older table refreshed by rowid, which SQLite hands out again once the newest row is deleted
+                self.connection.execute("ALTER TABLE negative_cache RENAME TO negative_cache_old")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS negative_cache (seq INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL UNIQUE, expires REAL NOT NULL, status INTEGER, reason TEXT NOT NULL)")
+            if columns and "seq" not in columns:
+                self.connection.execute("INSERT INTO negative_cache (url, expires, status, reason) SELECT url, expires, status, reason FROM negative_cache_old")
+                self.connection.execute("DROP TABLE negative_cache_old")
+            self.connection.commit()
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM negative_cache WHERE expires <= ?", (now,))
+            self.entries = {}
+            self.last_seq = 0
+        self.refresh_interval = 5 # seconds between picking up entries other worker processes added
+        self.refresh()
+
+    def refresh(self):
+        """Load entries added since the last refresh, by this process or any other. A replaced row gets a new seq, and AUTOINCREMENT never hands one out twice, so updates show up too"""
+        rows = self.reader.all("SELECT seq, url, expires, status, reason FROM negative_cache WHERE seq > ? ORDER BY seq", (self.last_seq,))
+        for seq, url, expires, status, reason in rows:
+            self.entries[url] = (expires, status, reason)
+            self.last_seq = seq
+        self.refreshed = time.time()
+
+    def ttl(self, status):
+        if status is None:
+            return self.ttls["error"]
+        if str(status) in self.ttls:
+            return self.ttls[str(status)]
+        if status >= 500:
+            return self.ttls["5xx"]
+        return self.ttls["4xx"]
+
+    def add(self, url, status, reason):
+        expires = time.time() + self.ttl(status)
+        self.entries[url] = (expires, status, reason)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO negative_cache (url, expires, status, reason) VALUES (?, ?, ?, ?)", (url, expires, status, reason))
+
+    def get(self, url):
+        """Get (expires, status, reason) if url is negatively cached, else None"""
+        if time.time() - self.refreshed > self.refresh_interval:
+            self.refresh()
+        entry = self.entries.get(url)
+        if entry is not None and entry[0] <= time.time():
+            self.entries.pop(url, None) # expired, give it another chance. The row is cleaned up on the next start
+            return None
+        return entry
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def import_error_list(self, error_list_path):
+        """Import the old permanent error_list file once, as plain 404s"""
+        with open(error_list_path, "r") as f:
+            urls = [url for url in f.read().split("\n") if url != ""]
+        expires = time.time() + self.ttl(404)
+        for url in urls:
+            self.entries[url] = (expires, 404, "imported from error_list")
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO negative_cache (url, expires, status, reason) VALUES (?, ?, ?, ?)", [(url, expires, 404, "imported from error_list") for url in urls])
+        os.replace(error_list_path, error_list_path + ".imported")
+        print("Imported", len(urls), "urls from", error_list_path, "into the negative cache.")
+
+    def get_stats(self):
+        now = time.time()
+        stats = {"entries": 0}
+        for expires, status, reason in list(self.entries.values()):
+            if expires > now:
+                stats["entries"] += 1
+                status_class = "error" if status is None else str(status)
+                stats[status_class] = stats.get(status_class, 0) + 1
+        return stats
+
+class PrefixMatcher:
+    """Matches urls against a list of prefixes (the ad list) with one compiled regex instead of a startswith() per prefix"""
+    def __init__(self, prefixes = ()):
+        self.prefixes = set()
+        self.pattern = None
+        self.update(prefixes)
+
+    def update(self, prefixes):
+        self.prefixes.update(prefix for prefix in prefixes if prefix != "")
+        if self.prefixes:
+            self.pattern = re.compile("|".join(re.escape(prefix) for prefix in sorted(self.prefixes)))
+
+    def matches(self, url):
+        return self.pattern is not None and self.pattern.match(url) is not None
+
+class HotCache:
+    """Byte-bounded in-memory cache of recently served response bodies, so hot assets don't get re-read from disk on every hit"""
+    def __init__(self, max_bytes:int = 64 * 1024 * 1024, max_object_size:int = 1024 * 1024, policy:str = "lru"):
+        assert policy in ("lru", "lfu"), "Hot cache policy must be lru or lfu"
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size # anything bigger is streamed from disk instead
+        self.policy = policy
+        self.objects = OrderedDict() # internet_file_path -> (body, content_type), least recently used first
+        self.hit_counts = {} # internet_file_path -> hits, for lfu
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "rejected": 0}
+
+    def get(self, key):
+        hot_object = self.objects.get(key)
+        if hot_object is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.objects.move_to_end(key)
+        self.hit_counts[key] += 1
+        return hot_object
+
+    def put(self, key, body, content_type):
+        if len(body) > self.max_object_size or len(body) > self.max_bytes:
+            self.stats["rejected"] += 1
+            return
+        self.remove(key)
+        self.objects[key] = (body, content_type)
+        self.hit_counts[key] = 0
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            if self.policy == "lfu":
+                victim = min(self.objects, key=self.hit_counts.get) # ties go to the least recently used, since objects is in recency order
+            else:
+                victim = next(iter(self.objects))
+            self.remove(victim)
+            self.stats["evictions"] += 1
+
+    def remove(self, key):
+        hot_object = self.objects.pop(key, None)
+        if hot_object is not None:
+            self.size -= len(hot_object[0])
+            del self.hit_counts[key]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats.update({"objects": len(self.objects), "bytes": self.size, "max_bytes": self.max_bytes, "policy": self.policy})
+        return stats
+
+class DownloadProgress:
+    """How much of a file being downloaded into the cache has been written so far, so range requests can be answered from the partial file before it's finished. Updated from the fetch thread, waited on from the event loop"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.temp_file_path = None # set once the body starts arriving
+        self.total = None # Content-Length, if the upstream sent one
+        self.written = 0
+        self.finished = False
+        self.changed = asyncio.Event() # replaced on every change, so a waiter can't miss one
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def start(self, temp_file_path, total):
+        self.temp_file_path, self.total, self.written = temp_file_path, total, 0
+        self.loop.call_soon_threadsafe(self.notify)
+
+    def advance(self, written):
+        self.written = written
+        self.loop.call_soon_threadsafe(self.notify)
+
+    def finish(self):
+        self.finished = True
+        self.notify()
+
+    async def wait_until(self, ready):
+        """Wait until ready() or the download is over. Returns ready()"""
+        while not ready() and not self.finished:
+            await self.changed.wait()
+        return ready()
+
+class HttpsRewriter:
+    """Incremental https:// -> http:// rewrite (to prevent mixed content errors) that also strips a leading BOM. Holds back any tail that could be the start of a split "https://" until the next chunk arrives"""
+    def __init__(self):
+        self.pending = ""
+        self.at_start = True
+
+    def feed(self, text):
+        text = self.pending + text
+        self.pending = ""
+        if self.at_start:
+            if len(text) < 3 and "ï»¿".startswith(text): # too short to tell if it's a BOM yet
+                self.pending = text
+                return ""
+            if text.startswith("\ufeff"): # remove BOM from the beginning of the file
+                text = text[1:]
+            elif text.startswith("ï»¿"): # UTF-8 BOM decoded as latin-1
+                text = text[3:]
+            self.at_start = False
+        text = text.replace("https://", "http://")
+        for keep in range(min(len(text), len("https://") - 1), 0, -1):
+            if "https://".startswith(text[-keep:]):
+                self.pending = text[-keep:]
+                return text[:-keep]
+        return text
+
+    def flush(self):
+        text = self.pending
+        self.pending = ""
+        return text
+
+@functools.lru_cache(maxsize=1024)
+def proxy_date(base_timestamp, day_month_sync, today):
+    """(year, month, day) served for base_timestamp (YYYYMMDD) on the real date today, following today's month and day if day_month_sync"""
+    timestamp_string = str(base_timestamp)
+    year = int(timestamp_string[:4])
+    month = int(timestamp_string[4:6])
+    day = int(timestamp_string[6:8])
+    if day_month_sync:
+        month = today.month
+        day = today.day
+        if month == 2 and day == 29 and not calendar.isleap(year): # no Feb 29 that year
+            day = 28
+    datetime.date(year, month, day) # raises ValueError for a date that doesn't exist
+    return year, month, day
+
+request_stages = contextvars.ContextVar("request_stages", default=None) # stage -> seconds for the request being handled, set by MetricsMiddleware
+
+class Metrics:
+    """Counters and per-stage latency histograms for /metrics, in the Prometheus text format"""
+    stage_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock() # stages are also timed on the fetch threads
+        self.counters = {} # (name, labels) -> value
+        self.stages = {} # stage -> bucket counts (the last bucket is +Inf), then the sum of seconds
+
+    def count(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items()))) # strings, so render can sort status=200 next to status="error"
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, stage, seconds):
+        """Record how long a stage took, in the histogram and in the current request's timings"""
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = [0] * (len(self.stage_buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.stage_buckets, seconds)] += 1
+            histogram[-1] += seconds
+        stages = request_stages.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + seconds
+
+    @contextlib.contextmanager
+    def time_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def render(self, counters = None, gauges = None):
+        """Everything recorded, plus extra {name: value} counters and gauges kept elsewhere"""
+        with self.lock:
+            counter_items = list(self.counters.items())
+            stages = {stage: list(histogram) for stage, histogram in self.stages.items()}
+        counter_items += [((name, ()), value) for name, value in (counters or {}).items()]
+        lines = []
+        last_metric = None
+        for (name, labels), value in sorted(counter_items):
+            metric = f"waycache_{name}_total"
+            if metric != last_metric:
+                lines.append(f"# TYPE {metric} counter")
+                last_metric = metric
+            lines.append(f"{metric}{self.format_labels(labels)} {value}")
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE waycache_{name} gauge")
+            lines.append(f"waycache_{name} {value}")
+        if stages:
+            lines.append("# TYPE waycache_stage_seconds histogram")
+        for stage, histogram in sorted(stages.items()):
+            cumulative = 0
+            for bucket, count in zip(self.stage_buckets + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f"waycache_stage_seconds_bucket{self.format_labels((('stage', stage), ('le', bucket)))} {cumulative}")
+            lines.append(f"waycache_stage_seconds_sum{self.format_labels((('stage', stage),))} {histogram[-1]:.6f}")
+            lines.append(f"waycache_stage_seconds_count{self.format_labels((('stage', stage),))} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """ASGI middleware that times each request until its last byte is sent, counts the bytes served, and logs the request's stage timings at debug level"""
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stages = {}
+        token = request_stages.set(stages)
+        start = time.perf_counter()
+        status = []
+        async def send_counted(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+            elif message["type"] == "http.response.body":
+                self.metrics.count("bytes_served", len(message.get("body", b"")))
+            await send(message)
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            self.metrics.observe("response", time.perf_counter() - start)
+            request_stages.reset(token)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("%s %s %s %s", scope["method"], scope["path"], status[0] if status else "-", " ".join(f"{stage}={seconds * 1000:.2f}ms" for stage, seconds in stages.items()))
+
 class WaybackCachingProxy:
     def __init__(self, timestamp:int = 20141010, worker_time:int = 4,day_month_sync: bool = False,
             eras = [
@@ -48,37 +1436,113 @@ class WaybackCachingProxy:
             templates: Jinja2Templates = None,
             worker: bool = False,
             fimfarchive_file_path: str = None,
+            host_limits: dict = None,
+            hot_cache_size: int = 64 * 1024 * 1024,
+            hot_cache_policy: str = "lru",
+            storage_backend: str = "files",
+            snapshot_resolution: bool = True,
+            html_max_age: int = 24 * 60 * 60,
+            asset_max_age: int = 365 * 24 * 60 * 60,
+            cache_max_bytes: int = None,
+            eviction_policy: str = "lru",
+            shared_rate_limits: bool = False,
+            wayback_url: str = "https://web.archive.org",
+            origin_url: str = None,
         ): # Default timestamp is 2014-03-27
         self.base_timestamp = timestamp
         self.day_month_sync = day_month_sync
-        self.work_queue = []
+        self.eras = [self.load_era(era) for era in eras] # other dates served alongside the default one, picked per request, see select_era
+        self.eras_by_name = {era["name"]: era for era in self.eras}
+        self.eras_by_port = {era["port"]: era for era in self.eras if "port" in era}
+        self.eras_by_host = {host: era for era in self.eras for host in era.get("hosts", [])}
+        self.work_queue = [] # heap of (priority, sequence, key, work)
+        self.queued_work = set() # keys of everything in work_queue, so the same job is never queued twice
+        self.work_sequence = itertools.count() # keeps equal priorities first in first out
+        self.work_available = asyncio.Event()
+        self.max_queued_work = 1000
         self.worker_time = worker_time
+        self.worker_count = 4 # concurrent prefetch jobs, the upstream rate limit still applies to all of them
+        self.worker_tasks = []
+        self.worker_enabled = worker
+        self.prefetch_stats = {"queued": 0, "fetched": 0, "already_cached": 0, "skipped": 0, "failed": 0, "dropped": 0}
+        self.wayback_url = wayback_url.rstrip("/") # where captures are fetched from, a local stand-in when benchmarking
+        self.wayback_host = parse.urlsplit(self.wayback_url).hostname
+        self.origin_url = origin_url.rstrip("/") if origin_url is not None else None # if set, the live-server fallback fetches <origin_url>/<host>/<path> instead of the real host
         self.fast_api_app = app
         self.fast_api_templates = templates
         self.cache_dir = "./cache"
-        self.wayback_lock = asyncio.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_dir = os.path.join(self.cache_dir, "locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.fetch_lock_count = 1024 # cross-process fetch locks are striped over this many lock files
+        startup_lock = ProcessLock(os.path.join(self.lock_dir, "startup.lock"))
+        startup_lock.acquire() # so only the first of several worker processes builds a new index
+        new_cache_index = not os.path.exists("cache_index.db")
+        self.cache_index = CacheIndex("cache_index.db")
+        self.blob_store = BlobStore(os.path.join(self.cache_dir, "blobs"))
+        assert storage_backend in ("files", "pack"), "Storage backend must be files or pack"
+        self.storage_backend = storage_backend
+        self.pack_store = None
+        if storage_backend == "pack": # objects live in large pack files instead of one file per object
+            self.pack_store = PackStore(os.path.join(self.cache_dir, "packs"), "cache_index.db")
+        if new_cache_index: # first run with an index, fill it from whatever is already cached
+            self.rebuild_cache_index()
+        startup_lock.release()
+        if host_limits is None:
+            host_limits = {
+                self.wayback_host: {"rate": 1, "burst": 3, "concurrency": 4}, # be gentle with the Wayback Machine
+            }
+        self.rate_limiter = RateLimiter(host_limits, shared_db_path="cache_index.db" if shared_rate_limits else None) # every other host (the live-origin fallback) gets RateLimiter's defaults
+        self.max_fetch_attempts = 4 # retries on 429/503 before giving up
+        self.hot_cache = HotCache(hot_cache_size, policy=hot_cache_policy)
+        self.variant_store = VariantStore(os.path.join(self.cache_dir, "variants"), "cache_index.db")
+        self.variant_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="variants") # compression stays off the fetch threads and the event loop
+        self.variants = {} # internet_file_path -> {encoding: (variant path, size)}, dropped whenever the path is written
+        self.downloads = {} # internet_file_path -> DownloadProgress of a file being cached right now
         self.user_agent = {
             "User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_6_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.6 Mobile/15E148 Safari/604.1 Ddg/17.6",
         }
-        # self.post_request_delay = 0.5
-        self.post_request_delay = 1
-        # self.post_request_delay = 6
+        self.post_request_delay = 1 # wait before retrying after a connection error
+        self.request_timeout = 60 # seconds, so a stuck upstream connection can't hold a fetch thread forever
+        self.fetch_workers = 8 # upstream fetches run on this many threads so they never block the event loop
+        self.fetch_pool = ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="wayback-fetch")
         self.session = requests.Session()
+        self.in_flight = {} # internet_file_path -> task of the upstream fetch currently caching it
+        self.stats = {
+            "upstream_fetches": 0, # misses that actually went upstream
+            "coalesced_fetches": 0, # misses that joined an in-flight fetch instead of fetching again
+            "cached_by_other_workers": 0, # misses another worker process cached before we got its fetch lock
+            "index_writes_skipped": 0, # stored bodies whose index write gave up on a locked database
+        }
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.fetch_workers, pool_maxsize=self.fetch_workers) # keep-alive connections for every fetch thread
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-        self.worker_thread = None
-        if worker:
-            self.worker_thread = self.start_worker() # Runs every 5 seconds by default, checks for work, does work, then resumes checking for work
 
         self.default_cache_length = 30 # 1 month~ in days
 
-        self.error_list = []
+        self.negative_cache = NegativeCache("cache_index.db") # replaces the old permanent error_list
+        self.snapshot_resolution = snapshot_resolution # resolve captures from a local CDX index instead of letting Wayback redirect
+        self.snapshot_index = SnapshotIndex("cache_index.db", wayback_url=self.wayback_url)
+        self.html_max_age = html_max_age # pages can change when the proxy date moves on
+        self.asset_max_age = asset_max_age # a cached capture of an asset never changes
+        self.validators = {} # internet_file_path -> response validator headers, dropped whenever the path is written
+        self.max_validators = 100000
+
+        assert eviction_policy in ("lru", "lfu"), "Eviction policy must be lru or lfu"
+        self.cache_max_bytes = cache_max_bytes # disk budget for cached bodies and their variants, None for no limit
+        self.eviction_policy = eviction_policy
+        self.eviction_low_watermark = 0.9 # once over budget, evict down to this fraction of it so eviction doesn't run on every write
+        self.eviction_interval = 60 # seconds between eviction passes
+        self.eviction_batch_size = 500
+        self.eviction_index = CacheIndex("cache_index.db") # own connection, so eviction queries never hold the lock request handling uses
+        self.eviction_task = None
+        self.metrics = Metrics()
+        self.evictor_lock = ProcessLock(os.path.join(self.lock_dir, "evictor.lock")) # only one worker process evicts
+        self.is_evictor = False
+        self.eviction_stats = {"runs": 0, "usage_bytes": None, "evicted": 0, "freed_bytes": 0, "backfilled": 0}
         if os.path.exists("error_list"):
-            with open("error_list", "r") as f:
-                self.error_list = f.read().split("\n")
-                self.error_list = [error for error in self.error_list if error != ""]
-        else:
-            with open("error_list", "w") as f:
-                f.write("")
+            self.negative_cache.import_error_list("error_list")
         self.ad_list = []
         if os.path.exists("ad_list"):
             with open("ad_list", "r") as f:
@@ -87,264 +1551,913 @@ class WaybackCachingProxy:
         else:
             with open("ad_list", "w") as f:
                 f.write("")
+        self.ad_matcher = PrefixMatcher(self.ad_list)
         
         print("Wayback Caching Proxy Time:",datetime.datetime.fromtimestamp(self.timestamp))
 
+    # Eviction
+
+    def start_evictor(self):
+        """Start the eviction task on the running event loop, the first time a request comes in. Only called when there's a cache_max_bytes budget to keep to"""
+        if self.eviction_task is None:
+            self.eviction_task = asyncio.ensure_future(self.evictor())
+
+    async def evictor(self):
+        """Keep the cache under cache_max_bytes. The database and disk work runs on a thread in small batches, so request handling never waits on it"""
+        while True:
+            try:
+                await asyncio.to_thread(self.eviction_index.flush_accesses, self.cache_index.take_accesses())
+                if not self.is_evictor:
+                    if not self.evictor_lock.acquire(blocking=False): # another worker process is evicting, just keep access times flowing
+                        await asyncio.sleep(self.eviction_interval)
+                        continue
+                    self.is_evictor = True
+                    await asyncio.to_thread(self.backfill_cache_objects)
+                usage = await asyncio.to_thread(self.cache_usage)
+                if usage > self.cache_max_bytes:
+                    log.info("Cache over budget: %s > %s bytes, evicting...", usage, self.cache_max_bytes)
+                    while usage > self.cache_max_bytes * self.eviction_low_watermark:
+                        evicted, freed = await asyncio.to_thread(self.evict_batch, set(self.in_flight) | set(self.downloads), usage - self.cache_max_bytes * self.eviction_low_watermark)
+                        for internet_file_path in evicted:
+                            self.forget_cached(internet_file_path)
+                        if not evicted:
+                            break
+                        usage -= freed
+                    log.info("Cache eviction done, now using %s bytes.", usage)
+                self.eviction_stats["usage_bytes"] = usage
+                self.eviction_stats["runs"] += 1
+            except Exception as e:
+                log.error("Eviction error: %s", e)
+            await asyncio.sleep(self.eviction_interval)
+
+    def cache_usage(self):
+        return self.eviction_index.stored_bytes() + self.variant_store.stored_bytes()
+
+    def backfill_cache_objects(self):
+        """Record sizes and digests for files cached before objects were tracked, so they count towards the budget and can be evicted"""
+        known = self.eviction_index.object_keys()
+        backfilled = 0
+        if self.pack_store is not None:
+            for key, digest, length in self.pack_store.objects():
+                if key not in known:
+                    self.eviction_index.add_file(self.cache_dir, os.path.join(self.cache_dir, key), digest, length)
+                    backfilled += 1
+        else:
+            for year, month, day, day_dir in walk_cache_days(self.cache_dir):
+                for root, dirs, files in os.walk(day_dir):
+                    for name in files:
+                        internet_file_path = os.path.join(root, name)
+                        if name.endswith(".part") or self.eviction_index.object_key(self.cache_dir, internet_file_path) in known:
+                            continue
+                        try:
+                            self.eviction_index.add_file(self.cache_dir, internet_file_path, self.blob_store.hash_file(internet_file_path), os.path.getsize(internet_file_path))
+                            backfilled += 1
+                        except FileNotFoundError:
+                            pass
+        self.eviction_stats["backfilled"] += backfilled
+        if backfilled > 0:
+            log.info("Recorded %s cached files for eviction.", backfilled)
+
+    def evict_batch(self, protected, need_bytes):
+        """Evict the least valuable cached files until need_bytes are freed or the batch runs out, skipping protected paths (ones being fetched). Runs on a thread. Returns (evicted paths, bytes freed)"""
+        date = datetime.datetime.fromtimestamp(self.timestamp)
+        oldest_date = date - datetime.timedelta(days=self.default_cache_length)
+        evicted = []
+        freed = 0
+        for key, digest, size in self.eviction_index.eviction_candidates(CacheIndex.date_key(oldest_date.year, oldest_date.month, oldest_date.day), CacheIndex.date_key(date.year, date.month, date.day), self.eviction_policy, self.eviction_batch_size):
+            internet_file_path = os.path.join(self.cache_dir, key)
+            if internet_file_path in protected:
+                continue
+            if self.pack_store is not None:
+                self.pack_store.remove(key)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(internet_file_path)
+                self.remove_empty_dirs(os.path.dirname(internet_file_path))
+            self.eviction_index.remove_file(self.cache_dir, internet_file_path)
+            evicted.append(internet_file_path)
+            if not self.eviction_index.digest_referenced(digest): # nothing points at this body anymore
+                freed += self.remove_body(digest, size)
+                if freed >= need_bytes:
+                    break
+        self.eviction_stats["evicted"] += len(evicted)
+        self.eviction_stats["freed_bytes"] += freed
+        return evicted, freed
+
+    def remove_body(self, digest, size):
+        """Delete a body and its variants once no cache path uses it. Returns the bytes freed"""
+        freed = 0
+        if self.pack_store is None:
+            blob_path = self.blob_store.blob_path(digest)
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(blob_path).st_nlink <= 1: # otherwise a file the index doesn't know about still links to it
+                    os.remove(blob_path)
+                    freed += size
+        else:
+            freed += size # the pack space comes back on the next repack
+        freed += self.variant_store.remove(digest)
+        self.snapshot_index.remove_digest(digest)
+        return freed
+
+    def remove_empty_dirs(self, dir_path):
+        """Remove dir_path and the directories above it while they're empty, stopping at the cache day directory"""
+        while True:
+            split_path = self.cache_index.split_cache_path(self.cache_dir, os.path.join(dir_path, "x"))
+            if split_path is None or split_path[1] == "x": # reached the day directory
+                return
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                return
+            dir_path = os.path.dirname(dir_path)
+
+    def forget_cached(self, internet_file_path):
+        """Drop everything held in memory about an evicted file"""
+        for variant_path, variant_size in self.variants.pop(internet_file_path, {}).values():
+            self.hot_cache.remove(variant_path)
+        self.hot_cache.remove(internet_file_path)
+        self.validators.pop(internet_file_path, None)
+
+    def usage_stats(self):
+        return {
+            "usage_bytes": self.cache_usage(),
+            "max_bytes": self.cache_max_bytes,
+            "policy": self.eviction_policy,
+            "eviction": self.eviction_stats,
+            "by_domain": self.eviction_index.usage_by("domain"),
+            "by_date": self.eviction_index.usage_by("date"),
+        }
+
     def start_worker(self):
-        return threading.Thread(target=self.worker, daemon=True).start()
+        """Start the prefetch workers on the running event loop, the first time there's work for them"""
+        if self.worker_enabled and not self.worker_tasks:
+            self.worker_tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.worker_count)]
+
+    def queue_work(self, work, priority:int = 0):
+        key = (work["type"], work.get("url"), work.get("accept"), work.get("date"))
+        if key in self.queued_work:
+            return False
+        if len(self.work_queue) >= self.max_queued_work:
+            self.prefetch_stats["dropped"] += 1
+            return False
+        self.queued_work.add(key)
+        heapq.heappush(self.work_queue, (priority, next(self.work_sequence), key, work))
+        self.work_available.set()
+        self.start_worker()
+        return True
 
     @property
     def timestamp(self):
         """Get the current timestamp of the Wayback Caching Proxy instance"""
-        # YYYYMMDDhhmmss
-        timestamp_string = str(self.base_timestamp)
-        year = int(timestamp_string[:4])
-        month = int(timestamp_string[4:6])
-        day = int(timestamp_string[6:8])
-        # Get system time
-        current_timestamp = datetime.datetime.now()
-        if self.day_month_sync:
-            month = current_timestamp.month
-            day = current_timestamp.day
-        return datetime.datetime(year, month, day).timestamp()
+        return datetime.datetime(*self.date()).timestamp()
     
     @property
     def year(self):
         """Get the year of the Wayback Caching Proxy instance"""
-        return datetime.datetime.fromtimestamp(self.timestamp).year
+        return self.date()[0]
     
     @property
     def wayback_timestamp(self):
         """Get the Wayback Machine timestamp of the Wayback Caching Proxy instance"""
-        timestamp = self.timestamp
-        date = datetime.datetime.fromtimestamp(timestamp)
-        return date.strftime("%Y%m%d%H%M%S")
+        return self.wayback_timestamp_of(self.date())
+
+    @staticmethod
+    def wayback_timestamp_of(date):
+        year, month, day = date
+        return f"{year:04d}{month:02d}{day:02d}000000" # YYYYMMDDhhmmss
+
+    @staticmethod
+    def load_era(era):
+        """An era from the eras setting: {"name", "timestamp": YYYYMMDD, optional "day_month_sync", "port" it's served on, "hosts" (proxy hostnames that select it)}. The original {"name", "start_range_timestamp": ms since the epoch} form still works"""
+        era = dict(era)
+        if "timestamp" not in era:
+            era["timestamp"] = int(datetime.datetime.fromtimestamp(era["start_range_timestamp"] / 1000).strftime("%Y%m%d"))
+        return era
+
+    def date(self, era = None):
+        """(year, month, day) served for era (one of self.eras, or None for the default date set by the timestamp file and /set_timestamp)"""
+        if era is None:
+            return proxy_date(self.base_timestamp, self.day_month_sync, datetime.date.today())
+        return proxy_date(era["timestamp"], era.get("day_month_sync", self.day_month_sync), datetime.date.today())
+
+    def select_era(self, headers, port = None, host = None):
+        """The era a request is for: an X-Wayback-Date (YYYYMMDD) or X-Wayback-Era header, the port it came in on, or the proxy hostname it was addressed to. None for the default date"""
+        requested_date = headers.get("x-wayback-date")
+        if requested_date is not None and requested_date[:8].isdigit():
+            return {"name": requested_date[:8], "timestamp": int(requested_date[:8]), "day_month_sync": False}
+        era = self.eras_by_name.get(headers.get("x-wayback-era"))
+        if era is None:
+            era = self.eras_by_port.get(port)
+        if era is None and host is not None:
+            era = self.eras_by_host.get(host.rsplit(":", 1)[0])
+        return era
+
+    def date_per_request(self, headers):
+        """Whether requests for the same url can get different dates: this one picked its date by header, or eras are picked by port or hostname, which browser caches can't see"""
+        return "x-wayback-date" in headers or "x-wayback-era" in headers or bool(self.eras_by_port or self.eras_by_host)
+
+    def request_date(self, headers, port = None, host = None):
+        """(year, month, day) to serve a request with, see select_era. A date that doesn't exist falls back to the default"""
+        era = self.select_era(headers, port, host)
+        try:
+            return self.date(era)
+        except ValueError:
+            return self.date()
     
-    def add_to_error_list(self, url):
-        with open("error_list", "a") as f:
-            f.write(url + "\n")
-        self.error_list.append(url)
+    def rebuild_cache_index(self):
+        self.cache_index.rebuild(self.cache_dir, self.pack_store.paths() if self.pack_store is not None else ())
+
+    # Cache storage - every read and write of cached bodies goes through these so the files and pack backends are interchangeable
+
+    def pack_key(self, internet_file_path):
+        return CacheIndex.object_key(self.cache_dir, internet_file_path)
+
+    def is_cached(self, internet_file_path):
+        if self.pack_store is not None:
+            return self.pack_store.lookup(self.pack_key(internet_file_path)) is not None
+        return os.path.exists(internet_file_path)
+
+    def cached_size(self, internet_file_path):
+        if self.pack_store is not None:
+            return self.pack_store.lookup(self.pack_key(internet_file_path))[2]
+        return os.path.getsize(internet_file_path)
+
+    def read_cached(self, internet_file_path):
+        if self.pack_store is not None:
+            return self.pack_store.read(self.pack_key(internet_file_path))
+        with open(internet_file_path, "rb") as f:
+            return f.read()
+
+    async def iter_cached(self, internet_file_path, start:int = 0, length:int = None, chunk_size:int = 256 * 1024):
+        """Stream a cached body, or length bytes of it from start, in chunks read with pread, without loading all of it"""
+        end = start + length if length is not None else self.cached_size(internet_file_path)
+        if self.pack_store is not None:
+            for offset in range(start, end, chunk_size):
+                yield await asyncio.to_thread(self.pack_store.read, self.pack_key(internet_file_path), offset, min(chunk_size, end - offset))
+            return
+        fd = os.open(internet_file_path, os.O_RDONLY)
+        try:
+            for offset in range(start, end, chunk_size):
+                yield await asyncio.to_thread(os.pread, fd, min(chunk_size, end - offset), offset)
+        finally:
+            os.close(fd)
+
+    def new_temp_path(self, internet_file_path):
+        """Where to write a download before it's moved into the cache"""
+        if self.pack_store is not None:
+            return os.path.join(self.pack_store.temp_dir, f"{uuid.uuid4().hex}.part")
+        os.makedirs(os.path.dirname(internet_file_path), exist_ok=True) # eviction removes directories that empty out
+        return f"{internet_file_path}.{uuid.uuid4().hex}.part" # next to the final file so the move into place is a rename
+
+    def store_cached(self, temp_file_path, internet_file_path, digest, capture = None):
+        """Move a finished download into the cache. capture is the (url, capture timestamp, body kind) it came from, if it's a Wayback capture"""
+        size = os.path.getsize(temp_file_path)
+        if self.pack_store is not None:
+            self.pack_store.add(self.pack_key(internet_file_path), temp_file_path, digest)
+        else:
+            self.blob_store.store(temp_file_path, internet_file_path, digest)
+        self.index_stored(self.cache_index.add_file, self.cache_dir, internet_file_path, digest, size, capture[1] if capture is not None else None)
+        self.validators.pop(internet_file_path, None)
+        self.variants.pop(internet_file_path, None)
+        if is_compressible(internet_file_path) and self.variant_store.min_size <= size <= self.variant_store.max_size:
+            self.variant_pool.submit(self.build_variants, internet_file_path, digest)
+        if capture is not None:
+            self.index_stored(self.snapshot_index.add_capture, capture[0], capture[1], capture[2], digest)
+
+    def index_stored(self, write, *args):
+        """Run an index write for a body that's already in place. If the database stays locked past its timeout (other workers, the evictor) the write is only logged, so a finished download isn't reported as failed and fetched again. rebuild_index catches the index up"""
+        try:
+            write(*args)
+        except sqlite3.OperationalError as e:
+            log.warning("Cache index busy, %s skipped for %s: %s", write.__name__, args[1], e)
+            self.stats["index_writes_skipped"] += 1
+
+    def cached_validators(self, internet_file_path, file_type, per_request = False):
+        """ETag, Last-Modified and Cache-Control headers for a cached file. The ETag is the body's digest and Last-Modified is the capture date (or the cache day), so neither needs the body read. per_request (see date_per_request) makes clients revalidate instead of keeping it forever"""
+        validators = self.validators.get(internet_file_path)
+        if validators is None:
+            validators = self.build_validators(internet_file_path, file_type)
+        if per_request:
+            return {**validators, "Cache-Control": "no-cache"} # the ETag still makes revalidating a 304
+        return validators
+
+    def build_validators(self, internet_file_path, file_type):
+        object_info = self.cache_index.object_info(self.cache_dir, internet_file_path)
+        captured = None
+        if object_info is not None:
+            digest, size, captured = object_info
+            etag = f'"{digest[:32]}"'
+        elif self.pack_store is not None: # packed before objects were recorded, its place in the packs is just as stable
+            pack, offset, length = self.pack_store.lookup(self.pack_key(internet_file_path))
+            etag = f'"{pack:x}-{offset:x}-{length:x}"'
+        else:
+            stat = os.stat(internet_file_path)
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        if captured is not None:
+            last_modified = datetime.datetime.strptime(captured, "%Y%m%d%H%M%S")
+        else:
+            date = self.cache_index.split_cache_path(self.cache_dir, internet_file_path)[0]
+            last_modified = datetime.datetime(date // 10000, date // 100 % 100, date % 100)
+        validators = {
+            "ETag": etag,
+            "Last-Modified": email.utils.format_datetime(last_modified.replace(tzinfo=datetime.timezone.utc), usegmt=True),
+            "Cache-Control": f"public, max-age={self.html_max_age}" if file_type == "html" else f"public, max-age={self.asset_max_age}, immutable",
+            "Accept-Ranges": "bytes",
+            "Vary": "X-Wayback-Date, X-Wayback-Era", # either header picks another date for the same url
+        }
+        if is_compressible(internet_file_path):
+            validators["Vary"] = "Accept-Encoding, " + validators["Vary"]
+        if len(self.validators) >= self.max_validators:
+            self.validators.clear()
+        self.validators[internet_file_path] = validators
+        return validators
+
+    @staticmethod
+    def not_modified(request_headers, validators):
+        """Whether a conditional request's If-None-Match or If-Modified-Since says the client's copy is still good"""
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None: # takes precedence over If-Modified-Since
+            etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+            etags = [re.sub(r"-(gzip|br)\"$", "\"", etag) for etag in etags] # a compressed variant is the same object
+            return "*" in etags or validators["ETag"] in etags
+        if_modified_since = request_headers.get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                return email.utils.parsedate_to_datetime(validators["Last-Modified"]) <= email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    @staticmethod
+    def range_applies(request_headers, validators):
+        """Whether a Range request should get a range: yes unless its If-Range names a version other than the cached one"""
+        if_range = request_headers.get("if-range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(("\"", "W/")): # an ETag, which has to match strongly
+            return if_range == validators["ETag"]
+        return if_range == validators["Last-Modified"]
+
+    def cached_range_response(self, internet_file_path, range_header, headers, body = None):
+        """206 with just the requested bytes of a cached file (or of body, if it's already in memory), read with pread. None if the Range header isn't one we serve"""
+        size = len(body) if body is not None else self.cached_size(internet_file_path)
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            return None
+        start, end = byte_range
+        if start >= size:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        headers = {**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+        if body is not None:
+            return Response(body[start:end + 1], status_code=206, headers=headers)
+        return StreamingResponse(self.iter_cached(internet_file_path, start, end - start + 1), status_code=206, headers=headers)
+
+    async def download_progress(self, internet_file_path, url, date = None):
+        """For a range request on a file that isn't cached yet: start caching it (or join the fetch already running) and return its DownloadProgress once the body is arriving. None if it finished or failed before that"""
+        if url.startswith("https://web.archive.org/web/"):
+            url = url.replace("https://web.archive.org/web/","")
+        if url in self.negative_cache:
+            return None
+        if internet_file_path in self.in_flight:
+            self.stats["coalesced_fetches"] += 1
+        else:
+            self.start_fetch(internet_file_path, lambda: self.cache_file(internet_file_path, url, date))
+        await asyncio.sleep(0) # let cache_file register its progress
+        progress = self.downloads.get(internet_file_path)
+        if progress is None or not await progress.wait_until(lambda: progress.temp_file_path is not None):
+            return None
+        return progress
+
+    def download_range_response(self, progress, range_header, headers):
+        """206 for a range of a file that's still downloading, streamed as the bytes get written. None if it can't be answered from the partial file"""
+        if progress.total is None: # no Content-Length, so ranges from the end can't be worked out until it's done
+            return None
+        byte_range = parse_range(range_header, progress.total)
+        if byte_range is None:
+            return None
+        start, end = byte_range
+        if start >= progress.total:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{progress.total}"})
+        try:
+            fd = os.open(progress.temp_file_path, os.O_RDONLY)
+        except FileNotFoundError: # finished while we were looking, it's in the cache now
+            return None
+        headers = {**headers, "Content-Range": f"bytes {start}-{end}/{progress.total}", "Content-Length": str(end - start + 1)}
+        return StreamingResponse(self.iter_download(progress, fd, start, end + 1), status_code=206, headers=headers)
+
+    async def iter_download(self, progress, fd, start, end, chunk_size:int = 256 * 1024):
+        temp_file_path = progress.temp_file_path
+        try:
+            position = start
+            while position < end:
+                await progress.wait_until(lambda: progress.written > position or progress.temp_file_path != temp_file_path)
+                if progress.temp_file_path != temp_file_path or progress.written <= position:
+                    raise IOError("Download failed or restarted before the requested range was written")
+                chunk = await asyncio.to_thread(os.pread, fd, min(chunk_size, end - position, progress.written - position), position)
+                position += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd) # the file may have been moved into the cache by now, the fd still reads it
+
+    # Compressed variants
+
+    def build_variants(self, internet_file_path, digest):
+        """Build the compressed variants of a cached body. Runs on the variant thread"""
+        try:
+            if self.variant_store.build(digest, self.read_cached(internet_file_path)):
+                self.variants.pop(internet_file_path, None)
+        except Exception as e:
+            log.error("Error building variants: %s | %s", internet_file_path, e)
+
+    def cached_variant(self, internet_file_path, accept_encoding):
+        """Get (encoding, variant path, size) of the best precompressed copy of a cached file the client accepts, or None"""
+        if accept_encoding == "" or not is_compressible(internet_file_path):
+            return None
+        encodings = accepted_encodings(accept_encoding)
+        if not encodings:
+            return None
+        variants = self.variants.get(internet_file_path)
+        if variants is None:
+            variants = self.variant_store.lookup(self.pack_key(internet_file_path))
+            if len(self.variants) >= self.max_validators:
+                self.variants.clear()
+            self.variants[internet_file_path] = variants
+        for encoding in encodings:
+            if encoding in variants:
+                return (encoding,) + variants[encoding]
+        return None
+
+    def build_all_variants(self):
+        """Build variants for everything already in the cache, recording digests for files cached before objects were"""
+        print("Building compressed variants for:", self.cache_dir)
+        if self.pack_store is not None:
+            objects = [(os.path.join(self.cache_dir, key), digest) for key, digest in self.pack_store.digests() if is_compressible(key)]
+        else:
+            objects = []
+            for year, month, day, day_dir in walk_cache_days(self.cache_dir):
+                for root, dirs, files in os.walk(day_dir):
+                    for name in files:
+                        internet_file_path = os.path.join(root, name)
+                        if name.endswith(".part") or not is_compressible(internet_file_path):
+                            continue
+                        object_info = self.cache_index.object_info(self.cache_dir, internet_file_path)
+                        if object_info is None:
+                            digest = self.blob_store.hash_file(internet_file_path)
+                            self.cache_index.add_file(self.cache_dir, internet_file_path, digest, os.path.getsize(internet_file_path))
+                        else:
+                            digest = object_info[0]
+                        objects.append((internet_file_path, digest))
+        for internet_file_path, digest in tqdm(objects):
+            self.build_variants(internet_file_path, digest)
+        print("Variants built:", self.variant_store.get_stats())
+
+    # Snapshot resolution
+
+    async def resolve_capture(self, url, wayback_timestamp, kind):
+        """Get the timestamp of the capture of url nearest wayback_timestamp, or None to let Wayback's redirect decide. The capture a redirect picked is recorded, and the CDX server is only asked when we've stored some other capture of url the answer could let us reuse"""
+        if not self.snapshot_resolution:
+            return None
+        capture_timestamp = self.snapshot_index.resolution(url, wayback_timestamp)
+        if capture_timestamp is not None:
+            return capture_timestamp
+        if not self.snapshot_index.has_list(url, wayback_timestamp):
+            if not self.snapshot_index.has_captures(url, kind): # nothing to reuse, the fetch itself tells us which capture we get
+                return None
+            try:
+                req = await self.fetch(self.snapshot_index.cdx_url(url, wayback_timestamp))
+                if req.status_code != 200:
+                    log.warning("CDX lookup failed: %s %s", req.status_code, url)
+                    return None
+                await asyncio.to_thread(self.snapshot_index.add_list, url, wayback_timestamp, req.text)
+            except Exception as e:
+                log.warning("CDX lookup error: %s", e)
+                return None
+        return self.snapshot_index.nearest(url, wayback_timestamp)
+
+    def reuse_capture(self, internet_file_path, url, capture_timestamp, kind):
+        """If this exact capture is already stored as the same kind of body (for another proxy date), point internet_file_path at it instead of downloading it again"""
+        digest = self.snapshot_index.capture_digest(url, capture_timestamp, kind)
+        if digest is None:
+            return False
+        if self.pack_store is not None:
+            if not self.pack_store.add_reference(self.pack_key(internet_file_path), digest):
+                return False
+        else:
+            blob_path = self.blob_store.blob_path(digest)
+            if not os.path.exists(blob_path):
+                return False
+            self.blob_store.link(blob_path, internet_file_path)
+        self.cache_index.add_file(self.cache_dir, internet_file_path, digest, self.cached_size(internet_file_path), capture_timestamp)
+        self.validators.pop(internet_file_path, None)
+        self.variants.pop(internet_file_path, None)
+        self.snapshot_index.stats["reused_captures"] += 1
+        log.info("Reusing capture %s of %s for: %s", capture_timestamp, url, internet_file_path)
+        return True
+
+    @staticmethod
+    def capture_of(req, url, kind):
+        """(url, capture timestamp, kind) from the final url of a Wayback response, after any redirect"""
+        match = re.search(r"/web/(\d{14})id_/", req.url)
+        return (url, match.group(1), kind) if match else None
+
+    def record_redirect(self, req, url, wayback_timestamp):
+        """Remember which capture Wayback's redirect picked for wayback_timestamp, so the next miss for it goes straight there"""
+        capture = self.capture_of(req, url, None)
+        if self.snapshot_resolution and capture is not None:
+            self.snapshot_index.add_resolution(url, wayback_timestamp, capture[1])
+
+    def fetch_blocking(self, url, on_response = None):
+        if on_response is None:
+            with self.metrics.time_stage("upstream_fetch"):
+                return self.session.get(url, headers=self.user_agent, timeout=self.request_timeout)
+        with self.metrics.time_stage("upstream_fetch"): # until the headers are in, the body is timed as it's written
+            req = self.session.get(url, headers=self.user_agent, timeout=self.request_timeout, stream=True)
+        try:
+            on_response(req) # consumes the body on this fetch thread while the host's rate limit slot is still held
+        finally:
+            req.close()
+        return req
+
+    async def fetch(self, url, on_response = None):
+        """GET a url with the shared session on the fetch thread pool, without blocking the event loop, under the upstream host's rate limit. If on_response is given, the body is streamed to it on the fetch thread instead of being loaded into memory"""
+        loop = asyncio.get_running_loop()
+        host = parse.urlsplit(url).hostname
+        for attempt in range(self.max_fetch_attempts):
+            waiting = time.perf_counter()
+            async with self.rate_limiter.slot(host):
+                self.metrics.observe("upstream_wait", time.perf_counter() - waiting)
+                try:
+                    req = await loop.run_in_executor(self.fetch_pool, contextvars.copy_context().run, self.fetch_blocking, url, on_response) # keep the request's stage timings
+                except Exception:
+                    self.rate_limiter.report(host, None)
+                    self.metrics.count("upstream_responses", status="error")
+                    raise
+            self.metrics.count("upstream_responses", status=req.status_code)
+            self.rate_limiter.report(host, req.status_code, req.headers.get("Retry-After"))
+            if req.status_code not in (429, 503):
+                break
+        return req
+
+    async def fetch_retrying(self, url, on_response = None, retry = lambda: True):
+        """fetch() that tries again after connection errors and timeouts, up to max_fetch_attempts times and while retry() says it can, then raises the last error"""
+        for attempt in range(self.max_fetch_attempts):
+            try:
+                return await self.fetch(url, on_response)
+            except Exception as e:
+                log.warning("Error fetching %s: %s", url, e)
+                if attempt + 1 == self.max_fetch_attempts or not retry():
+                    raise
+                await asyncio.sleep(self.post_request_delay)
+
+    def add_to_negative_cache(self, url, status, reason):
+        log.info("Negatively caching: %s | %s", url, reason)
+        self.negative_cache.add(url, status, reason)
 
     def add_to_ad_list(self, url):
         with open("ad_list", "a") as f:
             f.write(url + "\n")
         self.ad_list.append(url)
+        self.ad_matcher.update([url])
     
-    async def get_html(self, internet_file_path, url):
+    def fetch_lock(self, internet_file_path):
+        stripe = int(hashlib.sha1(internet_file_path.encode("utf-8")).hexdigest()[:8], 16) % self.fetch_lock_count
+        return ProcessLock(os.path.join(self.lock_dir, f"fetch-{stripe:04d}.lock"))
+
+    async def locked_fetch(self, internet_file_path, fetch):
+        """Run fetch() holding the cross-process lock for internet_file_path, unless another worker process cached it before we got the lock"""
+        lock = self.fetch_lock(internet_file_path)
+        with self.metrics.time_stage("lock_wait"):
+            await lock.acquire_async()
+        try:
+            if self.is_cached(internet_file_path): # another worker may have finished it between our miss and taking the lock, even if we didn't wait
+                self.stats["cached_by_other_workers"] += 1
+                return None, 200 # the caller reads it from the cache
+            return await fetch()
+        finally:
+            lock.release()
+
+    def start_fetch(self, internet_file_path, fetch):
+        """Start fetch() as the in-flight fetch for internet_file_path"""
+        task = asyncio.ensure_future(self.locked_fetch(internet_file_path, fetch))
+        self.in_flight[internet_file_path] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(internet_file_path, None)) # the fetch keeps going for the other waiters even if the first client disconnects
+        self.stats["upstream_fetches"] += 1
+        return task
+
+    async def single_flight(self, internet_file_path, fetch):
+        """Run fetch() for internet_file_path unless a fetch for it is already in flight, in which case wait for that one and share its result"""
+        if internet_file_path in self.in_flight:
+            self.stats["coalesced_fetches"] += 1
+            log.debug("Joining in-flight fetch: %s", internet_file_path)
+            with self.metrics.time_stage("lock_wait"):
+                return await asyncio.shield(self.in_flight[internet_file_path])
+        return await asyncio.shield(self.start_fetch(internet_file_path, fetch))
+
+    async def get_html(self, internet_file_path, url, date = None):
+        """Get a page as (html, status code), fetching the capture for date (year, month, day, default the proxy date) if it isn't cached. A page that isn't cached yet is streamed as it downloads, in which case html is an async iterator of chunks. Once it's cached html is None, like get_file, and the caller serves it from the cache"""
         if url.startswith("https://web.archive.org/web/"):
             url = url.replace("https://web.archive.org/web/","")
-        if url in self.error_list:
+        if url in self.negative_cache:
             return "Error: This page could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-        if not os.path.exists(internet_file_path): # if the file doesn't exist, generate it
-            print("Caching HTML from Wayback:", url)
-            async with self.wayback_lock:
-                request_url = f"https://web.archive.org/web/{self.wayback_timestamp}id_/{url}"
-                print("Caching HTML:", request_url)
-                req = None 
-                while req is None:
-                    try:
-                        # req = requests.get(request_url, heders=self.user_agent)
-                        req = self.session.get(request_url, headers=self.user_agent)
-                    except Exception as e:
-                        print("Error:",e)
-                    time.sleep(self.post_request_delay)
-                if req.status_code != 200:
-                    self.add_to_error_list(url)
-                    return "Error: This page could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-                raw_html = req.text
-                while "https://" in raw_html: # replace https with http to prevent mixed content errors
-                    raw_html = raw_html.replace("https://","http://") # replace https with http to prevent mixed content errors
-                if raw_html.startswith("ï»¿"): # remove BOM from the beginning of the file
-                    raw_html = raw_html[3:]
-                with open(internet_file_path, "w", encoding="utf-8") as f:
-                    f.write(raw_html)
-        else: # if the file exists, read it
-            print("Reading HTML from file:", internet_file_path)
-            with open(internet_file_path, "r", encoding="utf-8") as f:
-                raw_html = f.read()
-        return raw_html, 200
-
-    async def get_file(self, internet_file_path, url):
-        response_code = 200
+        if not self.is_cached(internet_file_path): # if the file doesn't exist, generate it
+            if internet_file_path not in self.in_flight: # stream the page to this client while it's written to the cache
+                chunks = asyncio.Queue()
+                task = self.start_fetch(internet_file_path, lambda: self.cache_html(internet_file_path, url, chunks, prefetch_links=True, date=date))
+                task.add_done_callback(lambda _: chunks.put_nowait(None)) # end of stream, however the fetch ended
+                if await chunks.get() is not None:
+                    return self.stream_chunks(chunks), 200
+                raw_html, response_code = await asyncio.shield(task) # finished before streaming anything, so it either failed or reused a stored capture
+            else:
+                raw_html, response_code = await self.single_flight(internet_file_path, None) # someone else is already caching it, wait for them then read it
+            if response_code != 200:
+                return raw_html, response_code
+        return None, 200
+
+    async def stream_chunks(self, chunks):
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    async def cache_html(self, internet_file_path, url, chunks = None, prefetch_links:bool = False, date = None):
+        log.info("Caching HTML from Wayback: %s", url)
+        date = date or self.date()
+        request_timestamp = self.wayback_timestamp_of(date)
+        capture_timestamp = await self.resolve_capture(url, request_timestamp, "html")
+        if capture_timestamp is not None:
+            if self.reuse_capture(internet_file_path, url, capture_timestamp, "html"):
+                return None, 200
+            request_timestamp = capture_timestamp # ask for the exact capture, no redirect
+        request_url = f"{self.wayback_url}/web/{request_timestamp}id_/{url}"
+        log.debug("Caching HTML: %s", request_url)
+        loop = asyncio.get_running_loop()
+        streamed = []
+        try:
+            # req = requests.get(request_url, heders=self.user_agent)
+            req = await self.fetch_retrying(request_url, lambda req: self.download_html(req, internet_file_path, url, loop, chunks, streamed), lambda: not streamed) # once part of the page went to the client, a retry can't be appended to that
+        except Exception as e:
+            if streamed:
+                raise
+            self.add_to_negative_cache(url, None, f"Wayback error: {e}")
+            return "Error: This page could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
+        if req.status_code == 200 and capture_timestamp is None:
+            self.record_redirect(req, url, request_timestamp)
+        if req.status_code != 200:
+            self.add_to_negative_cache(url, req.status_code, f"Wayback returned {req.status_code}")
+            return "Error: This page could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
+        if prefetch_links and self.worker_enabled: # warm the page's subresources before the browser asks for them
+            try:
+                await self.queue_page_links(internet_file_path, url, date)
+            except Exception as e:
+                log.error("Error queueing page links: %s", e)
+        return None, 200
+
+    async def queue_page_links(self, internet_file_path, url, date = None):
+        html = (await asyncio.to_thread(self.read_cached, internet_file_path)).decode("utf-8", errors="replace")
+        links = await asyncio.to_thread(extract_page_links, html, url)
+        date = date or self.date()
+        queued = 0
+        for kind, link in links:
+            priority, accept = prefetch_kinds[kind]
+            if self.queue_work({"type": "prefetch", "url": link, "accept": accept, "date": date}, priority):
+                queued += 1
+        self.prefetch_stats["queued"] += queued
+        log.debug("Queued %s of %s links for prefetch from: %s", queued, len(links), url)
+
+    def download_html(self, req, internet_file_path, url, loop, chunks, streamed):
+        """Stream a Wayback response through the https rewrite into the cache, and into chunks (an asyncio.Queue on loop) if given. Runs on a fetch thread"""
+        if req.status_code != 200:
+            return
+        decoder = codecs.getincrementaldecoder(req.encoding or "utf-8")(errors="replace")
+        rewriter = HttpsRewriter()
+        digest = hashlib.sha256()
+        rewrite_time = 0
+        write_time = 0
+        temp_file_path = self.new_temp_path(internet_file_path) # moved into place once complete, so readers never see half a page
+        try:
+            with open(temp_file_path, "wb") as f:
+                if chunks is not None:
+                    loop.call_soon_threadsafe(chunks.put_nowait, "") # headers are in and the page is good, start the response
+                for raw_chunk in req.iter_content(chunk_size=64 * 1024):
+                    start = time.perf_counter()
+                    html_chunk = rewriter.feed(decoder.decode(raw_chunk))
+                    rewrite_time += time.perf_counter() - start
+                    if html_chunk != "":
+                        html_bytes = html_chunk.encode("utf-8")
+                        start = time.perf_counter()
+                        digest.update(html_bytes)
+                        f.write(html_bytes)
+                        write_time += time.perf_counter() - start
+                        if chunks is not None:
+                            streamed.append(len(html_chunk))
+                            loop.call_soon_threadsafe(chunks.put_nowait, html_chunk)
+                start = time.perf_counter()
+                html_chunk = rewriter.feed(decoder.decode(b"", final=True)) + rewriter.flush()
+                rewrite_time += time.perf_counter() - start
+                if html_chunk != "":
+                    html_bytes = html_chunk.encode("utf-8")
+                    digest.update(html_bytes)
+                    f.write(html_bytes)
+                    if chunks is not None:
+                        loop.call_soon_threadsafe(chunks.put_nowait, html_chunk)
+            start = time.perf_counter()
+            self.store_cached(temp_file_path, internet_file_path, digest.hexdigest(), self.capture_of(req, url, "html"))
+            self.metrics.observe("rewrite", rewrite_time)
+            self.metrics.observe("disk_write", write_time + time.perf_counter() - start)
+        except BaseException:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+            raise
+
+    def download_file(self, req, internet_file_path, url, progress):
+        """Stream a response body into the cache, reporting progress so range requests can be served from the partial file. Runs on a fetch thread"""
+        if req.status_code != 200:
+            return
+        temp_file_path = self.new_temp_path(internet_file_path)
+        total = int(req.headers["Content-Length"]) if "Content-Length" in req.headers and "Content-Encoding" not in req.headers else None # requests decodes compressed bodies, so their length is unknown
+        digest = hashlib.sha256()
+        written = 0
+        write_time = 0
+        try:
+            with open(temp_file_path, "wb", buffering=0) as f: # unbuffered, so everything counted in progress is readable
+                progress.start(temp_file_path, total)
+                for chunk in req.iter_content(chunk_size=256 * 1024):
+                    start = time.perf_counter()
+                    f.write(chunk)
+                    digest.update(chunk)
+                    write_time += time.perf_counter() - start
+                    written += len(chunk)
+                    progress.advance(written)
+            start = time.perf_counter()
+            self.store_cached(temp_file_path, internet_file_path, digest.hexdigest(), self.capture_of(req, url, "raw"))
+            self.metrics.observe("disk_write", write_time + time.perf_counter() - start)
+        except BaseException:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+            raise
+
+    async def get_file(self, internet_file_path, url, date = None):
         if url.startswith("https://web.archive.org/web/"):
             url = url.replace("https://web.archive.org/web/","")
-        if url in self.error_list:
-            print("File in error list:", url)
+        if url in self.negative_cache:
+            log.debug("File in negative cache: %s", url)
             return "Error: This file could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-        if not os.path.exists(internet_file_path):
-            print("Caching file from Wayback:", url)
-            async with self.wayback_lock:
-                request_url = f"https://web.archive.org/web/{self.wayback_timestamp}id_/{url}"
-                print("Caching file:", request_url)
-                try:
-                    req = None 
-                    while req is None:
-                        try:
-                            # req = requests.get(request_url, headers=self.user_agent)
-                            req = self.session.get(request_url, headers=self.user_agent)
-                        except Exception as e:
-                            print("Error:",e)
-                            req = None
-                            time.sleep(self.post_request_delay)
-                        time.sleep(self.post_request_delay)
-                    if req.status_code == 200:
-                        raw_file = req.content
-                        with open(internet_file_path, "wb") as f:
-                            f.write(raw_file)
-                    else:
-                        response_code = req.status_code
-                except Exception as e:
-                    print("Error:",e)
-                    return "Error: This file could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-                if not os.path.exists(internet_file_path):
-                    # try to get the file from the real server if it's not in the Wayback Machine
-                    print("Caching file from real server:", url)
-                    if url.startswith("http://"):
-                        url = url.replace("http://","https://")
-                    try:
-                        req = None
-                        req = requests.get(url, headers=self.user_agent)
-                        time.sleep(self.post_request_delay)
-                        if req.status_code == 200:
-                            raw_file = req.content
-                            with open(internet_file_path, "wb") as f:
-                                f.write(raw_file)
-                        else:
-                            if response_code != 200:
-                                response_code = req.status_code
-                    except Exception as e:
-                        print("Error:",e)
-                        return "Error: This file could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-        else:
-            print("Reading file from file:", internet_file_path)
-            with open(internet_file_path, "rb") as f:
-                raw_file = f.read()
+        if not self.is_cached(internet_file_path):
+            return await self.single_flight(internet_file_path, lambda: self.cache_file(internet_file_path, url, date))
+        return None, 200 # already cached, the caller serves it straight from disk
+
+    async def cache_file(self, internet_file_path, url, date = None):
+        """Download a file into the cache, streaming it to disk. Returns (None, 200) once it's cached, the caller serves it from there"""
+        progress = DownloadProgress(asyncio.get_running_loop())
+        self.downloads[internet_file_path] = progress
+        try:
+            return await self.fetch_file(internet_file_path, url, progress, date)
+        finally:
+            self.downloads.pop(internet_file_path, None)
+            progress.finish()
+
+    async def fetch_file(self, internet_file_path, url, progress, date = None):
+        response_code = 200
+        reason = ""
+        log.info("Caching file from Wayback: %s", url)
+        request_timestamp = self.wayback_timestamp_of(date or self.date())
+        capture_timestamp = await self.resolve_capture(url, request_timestamp, "raw")
+        if capture_timestamp is not None:
+            if self.reuse_capture(internet_file_path, url, capture_timestamp, "raw"):
+                return None, 200 # the caller reads it from the cache
+            request_timestamp = capture_timestamp # ask for the exact capture, no redirect
+        request_url = f"{self.wayback_url}/web/{request_timestamp}id_/{url}"
+        log.debug("Caching file: %s", request_url)
+        try:
+            # req = requests.get(request_url, headers=self.user_agent)
+            req = await self.fetch_retrying(request_url, lambda req: self.download_file(req, internet_file_path, url, progress))
+            if req.status_code == 200 and capture_timestamp is None:
+                self.record_redirect(req, url, request_timestamp)
+            if req.status_code != 200:
+                response_code = req.status_code
+                reason = f"Wayback returned {req.status_code}"
+        except Exception as e:
+            response_code = None # no answer at all, negatively cached as an error unless the live server has it
+            reason = f"Wayback error: {e}"
+        if not self.is_cached(internet_file_path):
+            # try to get the file from the real server if it's not in the Wayback Machine
+            log.info("Caching file from real server: %s", url)
+            origin_url = url
+            if origin_url.startswith("http://"):
+                origin_url = origin_url.replace("http://","https://")
+            if self.origin_url is not None:
+                origin_url = self.origin_url + "/" + url.split("://", 1)[-1]
+            try:
+                req = None
+                req = await self.fetch(origin_url, lambda req: self.download_file(req, internet_file_path, url, progress))
+                if req.status_code == 200:
+                    response_code = 200
+                else:
+                    reason += f", live server returned {req.status_code}"
+            except Exception as e:
+                log.warning("Error fetching %s: %s", origin_url, e)
+                self.add_to_negative_cache(url, response_code, reason + f", live server error: {e}")
+                return "Error: This file could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
         if response_code != 200:
-            self.add_to_error_list(url)
+            self.add_to_negative_cache(url, response_code, reason)
             return "Error: This file could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-        return raw_file, response_code
+        return None, response_code
 
     def get_url_info(self, url, parameters, request_accepts, req_year, req_month, req_day): # Convert URL to Path info - Example: https://www.google.com/ -> ./internet/com/google/index.html, ./internet/com/google/, index.html, html - Example 2: https://www.google.com/search?q=hello -> ./internet/com/google/search/index.html, ./internet/com/google/search/, index.html, html
-        print("URL:", url)
-        if url.startswith("https://web.archive.org/web/"):
-            url = url.replace("https://web.archive.org/web/","") # remove the server url from the beginning of the url if it's there
-        if url.startswith("/"):
-            url = url[1:]
-        assert (url.startswith("http://") or url.startswith("https://")), "URL must start with http:// or https://"
-
-        path_chunks = url.replace("http://","").replace("https://","").split("/")
-        domain_parts = path_chunks.pop(0).split(".")
-        domain_parts = ["domain-"+part for part in domain_parts]
-        domain_parts[-1] = "tld-" + domain_parts[-1].replace("domain-","")
-        domain_parts.reverse()
-
-        path_parts = []
-        for part in domain_parts:
-            path_parts.append(part)
-        path_parts += path_chunks
-        path_parts = [part for part in path_parts if part != ""] # remove empty parts
-        path_parts = [part.replace(",","").replace(";","").replace(":","").replace("%","").replace("?","").replace("&","").replace("=","").replace("+","").replace("#","").replace("@","") for part in path_parts] # remove special characters
-        print("PATH PARTS:", path_parts)
+        start = time.perf_counter()
+        index_path, file_path, dir_path, filename, file_type, file_extension = url_to_cache_path(url, parameters, request_accepts)
+        mapped = time.perf_counter()
+        self.metrics.observe("path_mapping", mapped - start)
 
         most_recent_date = datetime.datetime(req_year, req_month, req_day)
-        cached_dates = []
-        for year in os.listdir(self.cache_dir):
-            if year.isdigit():
-                for month in os.listdir(os.path.join(self.cache_dir, year)):
-                    if month.isdigit():
-                        for day in os.listdir(os.path.join(self.cache_dir, year, month)):
-                            if day.isdigit():
-                                relative_path = []
-                                for part in path_parts:
-                                    if part == "http://www" or part == "https://www" or part == "www": # skip www to simulate a real website using www to mirror the non-www version
-                                        continue
-                                    relative_path.append(part)
-                                relative_path = "/".join(relative_path)
-                                if os.path.exists(os.path.join(self.cache_dir, year, month, day, relative_path)):
-                                    cached_dates.append(datetime.datetime(int(year), int(month), int(day)))
-        if len(cached_dates) > 0:
-            if max(cached_dates) > most_recent_date - datetime.timedelta(days=self.default_cache_length) and max(cached_dates) < most_recent_date:
-                print("Found recent cache:", max(cached_dates))
-                most_recent_date = max(cached_dates)
-
-        internet_file_path = [self.cache_dir, str(most_recent_date.year), str(most_recent_date.month), str(most_recent_date.day)]
-        config_file_path = []
-        for part in path_parts:
-            # print("PART:", part)
-            if part == "http://www" or part == "https://www" or part == "www": # skip www to simulate a real website using www to mirror the non-www version
-                continue
-            internet_file_path.append(part)
-            config_file_path.append(part)
-        internet_file_path = "/".join(internet_file_path)
-        internet_file_path = internet_file_path.replace("http://","").replace("https://","").replace(":8080","")
-        config_file_path = "/".join(config_file_path)
-        config_file_path = config_file_path.replace("http://","").replace("https://","").replace(":8080","")
-        
-        # Make sure the path would lead to a file, assume index.html if it's not, then make sure the path exists in the internet folder on the server
-        # print("INTERNET FILE PATH:", internet_file_path) # Example :{self.cache_dir}com/google/
-        if internet_file_path[-1] == "/": # if the path ends with a slash, assume index.html
-            if request_accepts == "text/html":
-                # print("html1")
-                internet_file_path += "index.html"
-            else:
-                internet_file_path += "index."+request_accepts.split("/")[1]
-        else:
-            # if internet_file_path.endswith("index.html") or internet_file_path.endswith("index.htm"): # if the path ends with index.html or index.htm, remove it
-            #     internet_file_path = internet_file_path[:-10]
-            dot_count = internet_file_path.count(".")
-            if dot_count <= 1: # if the path doesn't have a file extension, assume index.html
-                if request_accepts == "text/html":
-                    # print("html2")
-                    internet_file_path += "/index.html"
-                else:
-                    internet_file_path += "."+request_accepts.split("/")[1]
-
-        # Get the directory path and filename from the internet_file_path
-        internet_dir_path = "/".join(internet_file_path.split("/")[:-1])
-        if internet_dir_path[-1] != "/":
-            internet_dir_path += "/"
-        filename = internet_file_path.split("/")[-1]
-        # Determine the file_type of the path by the filename extension
-        file_type = "file"
-        image_filetypes = ["png","jpg","jpeg","gif"] # supported image filetypes
-        file_extension = filename.split(".")[-1]
-        if file_extension == "html" or file_extension == "php":
-            file_type = "html" # html file
-        if file_extension in image_filetypes:
-            file_type = "image" # image file
-        elif file_extension == "css":
-            file_type = "css"
-        # elif file_extension == "html":
-        #     file_type = "html" # html file
-        # elif file_extension == "js":
-        #     file_type = "js"
-        # else:
-        #     file_type = "file"
-        parameters = parameters.split("&")
-        for parameter in parameters:
-            if parameter == "":
-                continue
-            parameter = parameter.replace("=","--")
-            filename += "." + parameter
-            internet_file_path += "." + parameter
+        oldest_date = most_recent_date - datetime.timedelta(days=self.default_cache_length)
+        cached_date = self.cache_index.newest_date(index_path, CacheIndex.date_key(oldest_date.year, oldest_date.month, oldest_date.day), CacheIndex.date_key(req_year, req_month, req_day))
+        if cached_date is not None:
+            cached_date = datetime.datetime(cached_date // 10000, cached_date // 100 % 100, cached_date % 100)
+            if cached_date < most_recent_date:
+                log.debug("Found recent cache: %s", cached_date)
+                most_recent_date = cached_date
+        self.metrics.observe("index_lookup", time.perf_counter() - mapped)
 
-            
-        return internet_file_path, internet_dir_path, filename, file_type, file_extension # example:{self.cache_dir}com/google/index.html, {self.cache_dir}com/google/, index.html, html
+        day_path = f"{self.cache_dir}/{most_recent_date.year}/{most_recent_date.month}/{most_recent_date.day}/"
+        return day_path + file_path, day_path + dir_path, filename, file_type, file_extension # example:{self.cache_dir}com/google/index.html, {self.cache_dir}com/google/, index.html, html
     
-    def worker(self):
+    async def worker(self):
         while True:
             try:
-                time.sleep(self.worker_time + random.randint(5, 10)) # Sleep for worker_time + 5-10 seconds, offset to prevent all workers from running at the same time when running more than one worker
-                print("Worker checking for work...")
-                # Chec work_queue for work and do a task if there is anything in the queue
-                if len(self.work_queue) > 0:
-                    # print("Worker found work in queue.")
-                    work = self.work_queue.pop(0)
-                    print("Worker doing work:",work, "| Work Left:",len(self.work_queue))
-                    # Do work based on the work["type"]
+                if len(self.work_queue) == 0:
+                    self.work_available.clear()
+                    try:
+                        await asyncio.wait_for(self.work_available.wait(), self.worker_time)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.rate_limiter.host_state(self.wayback_host)["waiting"] > 0: # clients are waiting on the Wayback Machine, let them go first
+                    await asyncio.sleep(random.uniform(0.5, 1))
+                    continue
+                # Check work_queue for work and do the most important task in it
+                priority, sequence, key, work = heapq.heappop(self.work_queue)
+                self.queued_work.discard(key)
+                log.debug("Worker doing work: %s | Work Left: %s", work, len(self.work_queue))
+                # Do work based on the work["type"]
+                if work["type"] == "prefetch":
+                    self.prefetch_stats[await self.cache_url(work["url"], work["accept"], work["date"])] += 1
+                else:
                     raise ValueError("Unknown work type: " + work["type"] + ". Discarding invalid work.")
             except Exception as e:
-                print("Worker error:",e)
+                log.error("Worker error: %s", e)
+
+    async def cache_url(self, url, request_accepts, date):
+        """Cache a url for date (year, month, day) the same way catch_all would for a request with the given accept header. Returns fetched, already_cached, skipped or failed"""
+        url = url.replace("https://", "http://", 1) # pages are rewritten to http, so that's what the browser will ask for
+        if self.ad_matcher.matches(url) or url in self.negative_cache:
+            return "skipped"
+        path, parameters = url.split("?", 1) if "?" in url else (url, "")
+        year, month, day = date
+        internet_file_path, internet_dir_path, filename, file_type, file_extension = self.get_url_info(path, parameters, request_accepts, year, month, day)
+        if self.is_cached(internet_file_path):
+            return "already_cached"
+        if self.pack_store is None:
+            os.makedirs(internet_dir_path, exist_ok=True)
+        if file_type == "html" and request_accepts == "text/html":
+            content, response_code = await self.single_flight(internet_file_path, lambda: self.cache_html(internet_file_path, url, date=date))
+        else:
+            content, response_code = await self.get_file(internet_file_path, url, date)
+        return "fetched" if response_code == 200 else "failed"
+
+    async def warm_cache(self, list_path, concurrency:int = 4):
+        """Cache every url in a url list or CDX listing for the current proxy date. Finished urls are appended to <list_path>.<YYYYMMDD>.checkpoint so an interrupted run for that date picks up where it stopped. Failed urls aren't, so a later run tries them again"""
+        urls = read_url_list(list_path)
+        date = datetime.datetime.fromtimestamp(self.timestamp)
+        checkpoint_path = f"{list_path}.{date.strftime('%Y%m%d')}.checkpoint" # one per date, warming the list for another date starts over
+        done = set()
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                done = set(line for line in f.read().split("\n") if line != "")
+        todo = [(url, accept) for url, accept in urls if url not in done]
+        print("Warming cache for", date.strftime("%Y-%m-%d"), "|", len(todo), "urls to go,", len(urls) - len(todo), "already done")
+        results = {"fetched": 0, "already_cached": 0, "skipped": 0, "failed": 0}
+        semaphore = asyncio.Semaphore(concurrency)
+        progress = tqdm(total=len(urls), initial=len(urls) - len(todo))
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+            async def warm(url, accept):
+                async with semaphore:
+                    try:
+                        result = await self.cache_url(url, accept, (date.year, date.month, date.day))
+                    except Exception as e:
+                        print("Error warming", url, "|", e)
+                        result = "failed"
+                results[result] += 1
+                if result != "failed":
+                    checkpoint.write(url + "\n")
+                    checkpoint.flush()
+                progress.update(1)
+                progress.set_postfix(results)
+            await asyncio.gather(*[warm(url, accept) for url, accept in todo])
+        progress.close()
+        print("Cache warm-up finished:", results)
 
         
 
@@ -365,7 +2478,17 @@ with open("timestamp") as f:
     timestamp = int(f.read())
     print("Loaded timestamp from file:",timestamp)
 
-waycache = WaybackCachingProxy(timestamp, day_month_sync=True, app=app, templates=templates, worker=False)
+worker_processes = int(os.environ.get("WAYCACHE_WORKERS", "1")) # set by python main.py workers <n>
+wayback_url = os.environ.get("WAYCACHE_WAYBACK_URL", "https://web.archive.org") # benchmark.py points these at its fake upstream
+origin_url = os.environ.get("WAYCACHE_ORIGIN_URL")
+
+eras = []
+if os.path.exists("eras.json"): # optional, a list of eras to serve alongside the default date, see WaybackCachingProxy.load_era
+    with open("eras.json") as f:
+        eras = json.load(f)
+    print("Loaded", len(eras), "eras from eras.json")
+
+waycache = WaybackCachingProxy(timestamp, day_month_sync=True, eras=eras, app=app, templates=templates, worker=True, storage_backend="files", shared_rate_limits=worker_processes > 1, wayback_url=wayback_url, origin_url=origin_url) # storage_backend="pack" serves from pack files, see convert_to_packs
 
 # GLOBAL ROUTES - These are the same for all versions of the site. Typically these should be control panels, information pages, shared APIs, etc.
 
@@ -390,6 +2513,35 @@ def set_timestamp(request: Request):
     return {"success": False}
 
 
+@app.get("/stats")
+def get_stats():
+    return {
+        "fetches": waycache.stats,
+        "upstream_hosts": waycache.rate_limiter.get_stats(),
+        "hot_cache": waycache.hot_cache.get_stats(),
+        "negative_cache": waycache.negative_cache.get_stats(),
+        "prefetch": dict(waycache.prefetch_stats, queue_depth=len(waycache.work_queue)),
+        "snapshots": waycache.snapshot_index.get_stats(),
+        "variants": waycache.variant_store.get_stats(),
+    }
+
+@app.get("/stats/usage")
+async def get_usage_stats():
+    return await asyncio.to_thread(waycache.usage_stats)
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus scrape endpoint. Each worker process has its own metrics"""
+    counters = dict(waycache.stats)
+    counters.update({f"prefetch_{name}": value for name, value in waycache.prefetch_stats.items()})
+    gauges = {
+        "in_flight_fetches": len(waycache.in_flight),
+        "prefetch_queue_depth": len(waycache.work_queue),
+        "hot_cache_bytes": waycache.hot_cache.size,
+        "hot_cache_objects": len(waycache.hot_cache.objects),
+    }
+    return Response(waycache.metrics.render(counters, gauges), media_type="text/plain; version=0.0.4")
+
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(
@@ -416,13 +2568,14 @@ if external_ip == "":
 
 if external_ip != "":
     @app.get("/proxy.pac")
-    def generate_pac():
-        print("Generating PAC file...")
+    def generate_pac(era: str = None):
+        log.debug("Generating PAC file...")
+        port = waycache.eras_by_name[era].get("port", 8002) if era in waycache.eras_by_name else 8002 # /proxy.pac?era=<name> browses that era, if it has its own port
         pac_file_content = """
-    function FindProxyForURL(url, host) {
-        return "PROXY  {external_ip}:8002"; 
-    }
-    """.format(external_ip=external_ip)
+    function FindProxyForURL(url, host) {{
+        return "PROXY  {external_ip}:{port}"; 
+    }}
+    """.format(external_ip=external_ip, port=port)
         return Response(content=pac_file_content, media_type="application/x-ns-proxy-autoconfig")
 
 # Catch-all route for all other paths
@@ -431,105 +2584,123 @@ if external_ip != "":
 @app.get("/{path:path}/")
 @app.get("{path:path}")
 async def catch_all(path: str, request: Request):
-    path = str(request.url)
-    host_address_string = f"http://{host_address}:8002/"
-    if external_ip != "":
-        remote_host_address_string = f"http://{external_ip}:8002/"
-    if path.startswith(host_address_string):
-        path = path[len(host_address_string):]
-    if path.startswith(remote_host_address_string):
-        path = path[len(remote_host_address_string):]
-    if path.startswith("http:/"):
-        path = path.replace("http:/","")
-    if path.startswith("https:/"):
-        path = path.replace("https:/","")
-    while path.startswith("/"):
-        path = path[1:]
-    path = "http://"+path
-    print(path)
-    waycache_date = datetime.datetime.fromtimestamp(waycache.timestamp)
     req_headers = dict(request.headers)
-    # year = int(path)
-    year = waycache_date.year
-    month = waycache_date.month
-    day = waycache_date.day
+    server = request.scope.get("server")
+    date = waycache.request_date(req_headers, server[1] if server else None, req_headers.get("host"))
+    return await serve_proxy_request(normalize_request_url(str(request.url), host_address, external_ip), req_headers, date)
+
+async def serve_proxy_request(full_url, req_headers, date):
+    """Answer a request for full_url as it was on date (year, month, day) from the cache, fetching it first if needed. Shared by catch_all and ProxyFrontEnd"""
+    path = full_url
+    year, month, day = date
     if path.strip() != "" and path != "http://" and path != "http://favicon.ico" and path != "http://favicon.ico/":
-        invalid_path = False
-        for ad in waycache.ad_list:
-            if path.startswith(ad):
-                invalid_path = True
-                break
-        if invalid_path:
+        if waycache.ad_matcher.matches(path):
             return "Error: This page could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
-        print("Path:", path)
+        log.debug("Path: %s", path)
         # reject favicon requests
         if path == "favicon.ico":
             return ""
-        # if path starts with http://localhost:8080/, remove that part
-        if path.startswith("https://web.archive.org/web/"):
-            path = path.replace("https://web.archive.org/web/","")
-        # if path starts with internet/, remove that part
-        if path.startswith("internet/"):
-            path = path.replace("internet/","")
-        
         alt_text = "" 
         if "?alt=" in path:
             alt_text = path.split("?alt=")[-1].split("&")[0]
             alt_text = parse.unquote_plus(alt_text)
-            print("Alt text:", alt_text)
+            log.debug("Alt text: %s", alt_text)
         if len(path.split("?")) > 1:
             path, parameters = path.split("?",1)
         else:
             parameters = ""
 
-        full_url = str(request.url)
-        if full_url.startswith(host_address_string):
-            full_url = full_url[len(host_address_string):]
-        if full_url.startswith(remote_host_address_string):
-            full_url = full_url[len(remote_host_address_string):]
-        if full_url.startswith("http:/"):
-            full_url = full_url.replace("http:/","")
-        if full_url.startswith("https:/"):
-            full_url = full_url.replace("https:/","")
-        while full_url.startswith("/"):
-            full_url = full_url[1:]
-        full_url = "http://"+full_url
-
         url = path
-        print("URL:", url)
 
         request_accepts = req_headers.get("accept","text/html").split(",")[0].split(";")[0]
-        print("Accept:", request_accepts)
+        per_request = waycache.date_per_request(req_headers)
 
         internet_file_path, internet_dir_path, filename, file_type, file_extension = waycache.get_url_info(path, parameters, request_accepts, year, month, day)
+        if waycache.cache_max_bytes is not None: # without a budget nothing is evicted, so there's no need to walk the cache or track accesses
+            waycache.start_evictor()
+            waycache.cache_index.touch(waycache.cache_dir, internet_file_path)
 
-        print("INTERNET FILE PATH:", internet_file_path) # Example : ./internet/com/google/
-        print("INTERNET DIR PATH:", internet_dir_path) # Example : ./internet/com/google/index.html
-        print("FILE TYPE:", file_type) # Example : html, image
-        print("INTERNET FILENAME:", filename) # Example : index.html
+        log.debug("Request: %s | Accept: %s | Path: %s | Type: %s", url, request_accepts, internet_file_path, file_type) # Example : http://google.com/ | text/html | ./cache/2012/10/10/tld-com/domain-google/index.html | html
 
         if file_type == "image" and request_accepts == "text/html":
             request_accepts = "image/"+file_extension
         elif file_type == "css" and request_accepts == "text/html":
             request_accepts = "text/css"
-        print("Response Content:", request_accepts)
 
-        if not os.path.exists(internet_dir_path):
+        if ("if-none-match" in req_headers or "if-modified-since" in req_headers) and waycache.is_cached(internet_file_path):
+            validators = waycache.cached_validators(internet_file_path, file_type, per_request)
+            if waycache.not_modified(req_headers, validators):
+                waycache.metrics.count("cache_hits", source="not_modified")
+                return Response(status_code=304, headers=validators)
+
+        range_header = req_headers.get("range")
+        if range_header is not None and waycache.is_cached(internet_file_path):
+            validators = waycache.cached_validators(internet_file_path, file_type, per_request)
+            if waycache.range_applies(req_headers, validators):
+                hot_object = waycache.hot_cache.get(internet_file_path)
+                response = waycache.cached_range_response(internet_file_path, range_header, {"Content-Type": request_accepts, **validators}, hot_object[0] if hot_object is not None else None)
+                if response is not None:
+                    waycache.metrics.count("cache_hits", source="range")
+                    return response
+
+        variant = waycache.cached_variant(internet_file_path, req_headers.get("accept-encoding", "")) if range_header is None else None
+        if variant is not None:
+            encoding, variant_path, variant_size = variant
+            validators = waycache.cached_validators(internet_file_path, file_type, per_request)
+            headers = {"Content-Type": request_accepts, "Content-Encoding": encoding, **validators, "ETag": validators["ETag"][:-1] + f"-{encoding}\"", "Accept-Ranges": "none"}
+            waycache.variant_store.stats["served"] += 1
+            waycache.metrics.count("cache_hits", source="variant")
+            hot_object = waycache.hot_cache.get(variant_path)
+            if hot_object is not None:
+                return Response(hot_object[0], headers=headers)
+            if variant_size <= waycache.hot_cache.max_object_size:
+                with open(variant_path, "rb") as f:
+                    body = f.read()
+                waycache.hot_cache.put(variant_path, body, request_accepts)
+                return Response(body, headers=headers)
+            return FileResponse(variant_path, headers=headers)
+
+        hot_object = waycache.hot_cache.get(internet_file_path)
+        if hot_object is not None:
+            waycache.metrics.count("cache_hits", source="memory")
+            body, content_type = hot_object
+            return Response(body, headers={"Content-Type": content_type, **waycache.cached_validators(internet_file_path, file_type, per_request)})
+
+        if waycache.pack_store is None and not os.path.exists(internet_dir_path):
             os.makedirs(internet_dir_path, exist_ok=True)
 
+        if waycache.is_cached(internet_file_path):
+            waycache.metrics.count("cache_hits", source="disk")
+        else:
+            waycache.metrics.count("cache_misses")
+
         # input("Press Enter to continue...")
         try:
             if file_type == "html" and request_accepts == "text/html":
-                print("Getting HTML")
-                content, response_code = await waycache.get_html(internet_file_path, full_url)
-                return HTMLResponse(content, status_code=response_code, headers={"Content-Type": request_accepts})
+                content, response_code = await waycache.get_html(internet_file_path, full_url, date)
+                if content is not None and not isinstance(content, str): # not cached yet, stream it while it downloads
+                    return StreamingResponse(content, status_code=response_code, headers={"Content-Type": request_accepts})
             else:
-                print("Getting Generic File")
-                content, response_code = await waycache.get_file(internet_file_path, full_url)
-                print(response_code)
-                return FileResponse(internet_file_path, status_code=response_code, headers={"Content-Type": request_accepts})
+                if range_header is not None and "if-range" not in req_headers and not waycache.is_cached(internet_file_path): # seeking into something that's still downloading
+                    progress = await waycache.download_progress(internet_file_path, full_url, date)
+                    if progress is not None:
+                        response = waycache.download_range_response(progress, range_header, {"Content-Type": request_accepts, "Accept-Ranges": "bytes"})
+                        if response is not None:
+                            return response
+                content, response_code = await waycache.get_file(internet_file_path, full_url, date)
+            if response_code != 200:
+                return HTMLResponse(content, status_code=response_code)
+            headers = {"Content-Type": request_accepts, **waycache.cached_validators(internet_file_path, file_type, per_request)}
+            if content is None and waycache.cached_size(internet_file_path) <= waycache.hot_cache.max_object_size: # small cached page or file, read it once and keep it in memory
+                content = waycache.read_cached(internet_file_path)
+            if content is not None and len(content) <= waycache.hot_cache.max_object_size:
+                waycache.hot_cache.put(internet_file_path, content, request_accepts)
+                return Response(content, status_code=response_code, headers=headers)
+            if waycache.pack_store is not None:
+                return StreamingResponse(waycache.iter_cached(internet_file_path), status_code=response_code, headers={**headers, "Content-Length": str(waycache.cached_size(internet_file_path))})
+            return FileResponse(internet_file_path, status_code=response_code, headers=headers) # large files are streamed from disk
         except Exception as e:
-            print("Error:",e)
+            log.error("Error serving %s: %s", full_url, e)
             return "Error: This file could not be loaded. It may have been removed from the Wayback Machine or is not available at this time.", 404
         # elif file_type == "image":
         #     content = await waycache.get_media(internet_file_path, full_url)
@@ -545,17 +2716,91 @@ async def catch_all(path: str, request: Request):
 @app.post("/{path:path}/")
 @app.post("{path:path}")
 async def post_catch_all(path: str, request: Request):
-    print("POST request received.")
-    path = str(request.url)
-    print("Path:", path)
-    print("Headers:", dict(request.headers))
-    print("Body:", await request.body())
+    log.debug("POST request received: %s", request.url)
+    if log.isEnabledFor(logging.DEBUG): # only read the body when someone will see it
+        log.debug("Headers: %s", dict(request.headers))
+        log.debug("Body: %s", await request.body())
     return "POST request received."
 
 # @app.get("/proxy.pac")
 # async def proxy_pac():
 #     return FileResponse("proxy.pac")
 
+class ProxyFrontEnd:
+    """ASGI entry point in front of the FastAPI app. Browsers set up through /proxy.pac send absolute-URI requests whose Host is the site they want, and those GETs go straight to serve_proxy_request without FastAPI's routing, Request objects or header copies. Requests addressed to the proxy itself (the control endpoints, /proxy.pac, http://proxy:8002/http://... urls) and everything else go to the app"""
+    def __init__(self, app):
+        self.app = app
+        self.own_hosts = {} # listening (host, port) -> Host header values that mean the proxy itself
+
+    def is_own_host(self, scope, host):
+        server = scope.get("server")
+        own_hosts = self.own_hosts.get(server)
+        if own_hosts is None:
+            port = server[1] if server else 8002
+            names = [name for name in (host_address, external_ip, "localhost", "127.0.0.1", server[0] if server else "", *waycache.eras_by_host) if name]
+            own_hosts = self.own_hosts[server] = {f"{name}:{port}" for name in names} | (set(names) if port == 80 else set())
+        return host in own_hosts
+
+    @staticmethod
+    def request_url(scope, host):
+        """The url a forward-proxy request asks for. h11 leaves an absolute-URI request target whole in path, httptools keeps just its path, in which case the site comes from Host"""
+        url = scope["path"]
+        if not url.startswith(("http://", "https://")): # origin form
+            url = f"http://{host}{url}"
+        if scope["query_string"]:
+            url += "?" + scope["query_string"].decode("latin-1")
+        return url
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        req_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in reversed(scope["headers"])} # first value wins, like Starlette's Headers
+        host = req_headers.get("host", "")
+        if host == "" or self.is_own_host(scope, host):
+            return await self.app(scope, receive, send)
+        url = self.request_url(scope, host)
+        server = scope.get("server")
+        date = waycache.request_date(req_headers, server[1] if server else None) # Host is the site asked for here, so no hostname eras
+        response = await serve_proxy_request(normalize_request_url(url, host_address, external_ip), req_headers, date)
+        if not isinstance(response, Response):
+            response = JSONResponse(response) # what FastAPI does with catch_all's plain return values
+        await response(scope, receive, send)
+
+proxy_app = MetricsMiddleware(ProxyFrontEnd(app), waycache.metrics) # what uvicorn serves
+proxy_keep_alive = 60 # seconds an idle browser connection stays open, so page loads reuse connections instead of reconnecting
+
 
 # Run the server
-uvicorn.run(app, host=host_address, port=8002)
\ No newline at end of file
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild_index": # python main.py rebuild_index - rescan ./cache into the cache index
+        waycache.rebuild_cache_index()
+    elif len(sys.argv) > 1 and sys.argv[1] == "dedup_cache": # python main.py dedup_cache - convert existing cached files into deduplicated blobs
+        waycache.blob_store.migrate(waycache.cache_dir)
+    elif len(sys.argv) > 1 and sys.argv[1] == "dedup_report": # python main.py dedup_report - show how much space deduplication is saving
+        waycache.blob_store.print_report()
+    elif len(sys.argv) > 1 and sys.argv[1] == "convert_to_packs": # python main.py convert_to_packs - move the cache directory tree into pack files (then set storage_backend="pack" to serve from them)
+        pack_store = waycache.pack_store or PackStore(os.path.join(waycache.cache_dir, "packs"), "cache_index.db")
+        pack_store.convert(waycache.cache_dir)
+    elif len(sys.argv) > 1 and sys.argv[1] == "repack": # python main.py repack - compact the pack files, dropping objects nothing points at anymore
+        pack_store = waycache.pack_store or PackStore(os.path.join(waycache.cache_dir, "packs"), "cache_index.db")
+        pack_store.repack()
+    elif len(sys.argv) > 1 and sys.argv[1] == "build_variants": # python main.py build_variants - precompress text already in the cache
+        waycache.build_all_variants()
+    elif len(sys.argv) > 2 and sys.argv[1] == "warm": # python main.py warm <url list or CDX file> [YYYYMMDD] [concurrency] - fill the cache without browsing
+        if len(sys.argv) > 3:
+            waycache.base_timestamp = int(sys.argv[3])
+            waycache.day_month_sync = False # warm the exact date asked for
+        waycache.worker_enabled = False # no prefetching from the pages being warmed, the list decides what gets cached
+        asyncio.run(waycache.warm_cache(sys.argv[2], int(sys.argv[4]) if len(sys.argv) > 4 else 4))
+    elif len(sys.argv) > 2 and sys.argv[1] == "workers": # python main.py workers <n> - run n worker processes sharing one cache
+        os.environ["WAYCACHE_WORKERS"] = sys.argv[2] # each worker imports main itself and picks this up
+        uvicorn.run("main:proxy_app", host=host_address, port=8002, workers=int(sys.argv[2]), timeout_keep_alive=proxy_keep_alive) # eras with their own port are only served by the single process server, select them by header or hostname here
+    else:
+        ports = [8002] + sorted(port for port in waycache.eras_by_port if port != 8002) # one server, listening on 8002 and each era's port
+        sockets = []
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host_address, port))
+            sockets.append(sock)
+        uvicorn.Server(uvicorn.Config(proxy_app, host=host_address, port=8002, timeout_keep_alive=proxy_keep_alive)).run(sockets=sockets)
\ No newline at end of file